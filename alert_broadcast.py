@@ -0,0 +1,333 @@
+# alert_broadcast.py
+
+"""
+This file contains the emergency alert broadcast jobs.
+Sending an alert to every subscriber used to happen inside the admin's HTTP request, one Twilio call
+at a time. A broadcast now runs as a job in a background thread: messages are sent through the Twilio
+Messages API with bounded concurrency (asyncio + aiohttp), capped at a configurable number of messages
+per second, and transient errors are retried with exponential backoff.
+
+Every (alert, recipient) pair has a row in the delivery ledger (alert_deliveries) recording its
+status and outcome. Jobs checkpoint to the ledger as they go, so if a worker dies mid-broadcast
+another one resumes where it stopped, without texting anyone twice. The admin dashboard shows the
+progress and throughput of each broadcast from the ledger.
+
+TWILIO_API_BASE points the jobs at another endpoint, such as the local fake in fake_twilio.py.
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import threading
+from datetime import datetime, timedelta
+import aiohttp
+from sqlalchemy import func, insert, literal, select, update
+from database import db, EmergencyAlertUsers, EmergencyAlerts, AlertDelivery
+
+# Twilio REST API, and the credentials the messages are sent with
+TWILIO_API_BASE = os.environ.get("TWILIO_API_BASE", "https://api.twilio.com")
+# Maximum number of messages in flight at once
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+# Maximum number of messages sent per second. Match this to the sending number's Twilio throughput.
+BROADCAST_MESSAGES_PER_SECOND = float(os.environ.get("BROADCAST_MESSAGES_PER_SECOND", "10"))
+# How many times a message is retried after a transient error
+BROADCAST_MAX_RETRIES = int(os.environ.get("BROADCAST_MAX_RETRIES", "4"))
+# Seconds to wait before the first retry. Doubles with each retry.
+BROADCAST_RETRY_BACKOFF = float(os.environ.get("BROADCAST_RETRY_BACKOFF", "1"))
+
+# Recipients sent between checkpoints of the delivery ledger
+BROADCAST_CHECKPOINT_SIZE = int(os.environ.get("BROADCAST_CHECKPOINT_SIZE", "100"))
+# A 'sending' alert whose heartbeat is older than this is assumed to have lost its worker, and is resumed
+BROADCAST_STALE_SECONDS = float(os.environ.get("BROADCAST_STALE_SECONDS", "120"))
+# How often (in seconds) a running broadcast refreshes its heartbeat, however long its chunk takes to send.
+# Keep it well under BROADCAST_STALE_SECONDS.
+BROADCAST_HEARTBEAT_SECONDS = float(os.environ.get("BROADCAST_HEARTBEAT_SECONDS", "15"))
+
+# Statuses of a delivery in the ledger
+DELIVERY_STATUSES = ('pending', 'sending', 'sent', 'failed', 'skipped', 'unknown')
+
+# HTTP statuses worth retrying: rate limiting and server errors
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+# Spaces requests evenly so no more than `rate` start per second
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# Raised for a failed send that is worth retrying
+class TransientSendError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class BroadcastJob:
+    """
+    Sends one EmergencyAlerts row to its recipients in the delivery ledger (AlertDelivery).
+    Recipients are sent in chunks of BROADCAST_CHECKPOINT_SIZE. Before a chunk is sent its deliveries are
+    marked 'sending', and afterwards each outcome is written back, so a job restarted by another worker
+    picks up exactly at the first delivery still 'pending'. Every checkpoint refreshes the alert's heartbeat.
+    While a chunk is sent, a timer also refreshes it every BROADCAST_HEARTBEAT_SECONDS, so the job isn't
+    taken for dead during a chunk of slow sends or long retries.
+    """
+    def __init__(self, alert_id):
+        self.alert_id = alert_id
+
+    # Runs the whole job. Called in a background thread with the Flask app.
+    def run(self, app):
+        with app.app_context():
+            try:
+                asyncio.run(self._run())
+            except Exception as e:
+                # The alert stays 'sending', so once its heartbeat is stale another worker resumes it
+                db.session.rollback()
+                print(f"Error in alert broadcast {self.alert_id}: {e}", file=sys.stderr)
+
+    async def _run(self):
+        alert = db.session.get(EmergencyAlerts, self.alert_id)
+        if alert is None or alert.status != 'sending':
+            return
+        body = alert.sms_body
+        self._prepare()
+        account_sid = os.getenv('TWILIO_ACCOUNT_SID')
+        auth_token = os.getenv('TWILIO_AUTH_TOKEN')
+        from_ = os.getenv('TWILIO_FROM')
+        url = f"{TWILIO_API_BASE}/2010-04-01/Accounts/{account_sid}/Messages.json"
+        rate_limiter = RateLimiter(BROADCAST_MESSAGES_PER_SECOND)
+        auth = aiohttp.BasicAuth(account_sid or "", auth_token or "")
+        timeout = aiohttp.ClientTimeout(total=30)
+        engine = db.engine
+        async with aiohttp.ClientSession(auth=auth, timeout=timeout) as session:
+            for chunk in self._pending_chunks():
+                self._mark_sending([delivery_id for delivery_id, _, _ in chunk])
+                chunk_sent = asyncio.Event()
+                heartbeat = asyncio.create_task(self._heartbeat(engine, chunk_sent))
+                try:
+                    outcomes = await self._send_chunk(session, rate_limiter, url, from_, body, chunk)
+                finally:
+                    # Waits for a heartbeat write in progress, so it never overlaps the checkpoint
+                    chunk_sent.set()
+                    await heartbeat
+                self._checkpoint(chunk, outcomes)
+        self._finish()
+
+    # Streams the pending deliveries with their phone numbers, BROADCAST_CHECKPOINT_SIZE at a time.
+    # Each chunk is fetched with keyset pagination (id > the last id seen), so only one chunk is in memory
+    # however many subscribers there are, and each query stays an index range scan.
+    def _pending_chunks(self):
+        last_id = 0
+        while True:
+            chunk = (db.session.query(AlertDelivery.id, AlertDelivery.alert_user_id, EmergencyAlertUsers.phone_number)
+                     .join(EmergencyAlertUsers, EmergencyAlertUsers.id == AlertDelivery.alert_user_id)
+                     .filter(AlertDelivery.alert_id == self.alert_id, AlertDelivery.status == 'pending',
+                             AlertDelivery.id > last_id)
+                     .order_by(AlertDelivery.id).limit(BROADCAST_CHECKPOINT_SIZE).all())
+            if not chunk:
+                return
+            yield chunk
+            last_id = chunk[-1].id
+
+    # Deliveries left 'sending' by a worker that died may or may not have gone out.
+    # They are marked 'unknown' rather than sent again, so nobody is double-texted.
+    # Subscribers who unsubscribed since the alert was created are skipped.
+    def _prepare(self):
+        now = datetime.now()
+        AlertDelivery.query.filter_by(alert_id=self.alert_id, status='sending').update(
+            {AlertDelivery.status: 'unknown', AlertDelivery.updated_at: now}, synchronize_session=False)
+        AlertDelivery.query.filter(AlertDelivery.alert_id == self.alert_id, AlertDelivery.status == 'pending',
+                                   ~AlertDelivery.alert_user_id.in_(db.session.query(EmergencyAlertUsers.id))).update(
+            {AlertDelivery.status: 'skipped', AlertDelivery.updated_at: now}, synchronize_session=False)
+        db.session.commit()
+
+    def _mark_sending(self, delivery_ids):
+        now = datetime.now()
+        AlertDelivery.query.filter(AlertDelivery.id.in_(delivery_ids)).update(
+            {AlertDelivery.status: 'sending', AlertDelivery.updated_at: now}, synchronize_session=False)
+        EmergencyAlerts.query.filter_by(id=self.alert_id).update({EmergencyAlerts.heartbeat_at: now}, synchronize_session=False)
+        db.session.commit()
+
+    # Refreshes the heartbeat every BROADCAST_HEARTBEAT_SECONDS until chunk_sent is set.
+    # The UPDATE runs in a worker thread, on its own connection: the sends on the event loop aren't held up
+    # by the database round trip, and the job's session (used by the checkpoints) isn't touched.
+    async def _heartbeat(self, engine, chunk_sent):
+        while True:
+            try:
+                await asyncio.wait_for(chunk_sent.wait(), BROADCAST_HEARTBEAT_SECONDS)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await asyncio.to_thread(self._write_heartbeat, engine)
+            except Exception as e:
+                print(f"Error refreshing the heartbeat of alert broadcast {self.alert_id}: {e}", file=sys.stderr)
+
+    def _write_heartbeat(self, engine):
+        with engine.begin() as connection:
+            connection.execute(update(EmergencyAlerts).where(EmergencyAlerts.id == self.alert_id)
+                               .values(heartbeat_at=datetime.now()))
+
+    async def _send_chunk(self, session, rate_limiter, url, from_, body, chunk):
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+        async def send(delivery_id, phone_number):
+            async with semaphore:
+                return await send_with_retries(session, rate_limiter, url, from_, phone_number, body, delivery_id)
+
+        return await asyncio.gather(*(send(delivery_id, phone_number) for delivery_id, _, phone_number in chunk))
+
+    # Writes the outcome of each delivery in the chunk, bumps the alert counters of the subscribers it was
+    # delivered to (one set-based UPDATE ... WHERE id IN (...)), and records the alert's progress, all in
+    # one transaction. A delivery is only marked 'sent' together with its counter, so counters are bumped
+    # exactly once even if the job is resumed.
+    def _checkpoint(self, chunk, outcomes):
+        now = datetime.now()
+        for outcome in outcomes:
+            outcome["updated_at"] = now
+        db.session.execute(update(AlertDelivery), outcomes)
+        alert_user_ids = {delivery_id: alert_user_id for delivery_id, alert_user_id, _ in chunk}
+        delivered = [alert_user_ids[outcome["id"]] for outcome in outcomes if outcome["status"] == 'sent']
+        if delivered:
+            EmergencyAlertUsers.query.filter(EmergencyAlertUsers.id.in_(delivered)).update(
+                {EmergencyAlertUsers.total_alerts: EmergencyAlertUsers.total_alerts + 1}, synchronize_session=False)
+        EmergencyAlerts.query.filter_by(id=self.alert_id).update(
+            {EmergencyAlerts.number_of_users_sent: EmergencyAlerts.number_of_users_sent + len(delivered),
+             EmergencyAlerts.heartbeat_at: now}, synchronize_session=False)
+        db.session.commit()
+
+    # Completes the alert, unless another worker already did
+    def _finish(self):
+        EmergencyAlerts.query.filter_by(id=self.alert_id, status='sending').update(
+            {EmergencyAlerts.status: 'complete', EmergencyAlerts.finished_at: datetime.now()}, synchronize_session=False)
+        db.session.commit()
+
+
+# Sends one alert SMS, retrying transient errors with exponential backoff.
+# Returns the delivery's outcome as a dict of AlertDelivery columns.
+async def send_with_retries(session, rate_limiter, url, from_, phone_number, body, delivery_id):
+    outcome = {"id": delivery_id, "status": "failed", "attempts": 0, "twilio_sid": None, "error": None}
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await rate_limiter.wait()
+        outcome["attempts"] = attempt + 1
+        try:
+            outcome["twilio_sid"] = await send_sms(session, url, from_, phone_number, body)
+            outcome["status"] = "sent"
+            outcome["error"] = None
+            return outcome
+        except TransientSendError as e:
+            outcome["error"] = str(e)
+            if attempt == BROADCAST_MAX_RETRIES:
+                break
+            # Exponential backoff with jitter, or what Twilio asked for
+            delay = e.retry_after or BROADCAST_RETRY_BACKOFF * (2 ** attempt) * (0.5 + random.random())
+            await asyncio.sleep(delay)
+        except Exception as e:
+            # Permanent errors (an invalid or unsubscribed number) aren't retried
+            outcome["error"] = str(e)
+            break
+    return outcome
+
+
+# Sends one SMS through the Twilio Messages API and returns its sid
+async def send_sms(session, url, from_, to, body):
+    try:
+        async with session.post(url, data={"To": to, "From": from_, "Body": body}) as response:
+            if response.status in (200, 201):
+                return (await response.json()).get("sid")
+            text = await response.text()
+            if response.status in RETRYABLE_STATUSES:
+                retry_after = response.headers.get("Retry-After")
+                raise TransientSendError(f"HTTP {response.status}: {text}", float(retry_after) if retry_after and retry_after.isdigit() else None)
+            raise RuntimeError(f"HTTP {response.status}: {text}")
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+        raise TransientSendError(f"{type(e).__name__}: {e}")
+
+
+# Creates the alert and its delivery ledger (one 'pending' row per current subscriber, inserted with
+# a single INSERT ... SELECT), then starts the broadcast job in a background thread
+def start_broadcast(app, message, sanitized_message):
+    now = datetime.now()
+    alert = EmergencyAlerts(message=sanitized_message, sms_body=message, status='sending', timestamp=now,
+                            started_at=now, heartbeat_at=now, number_of_users_sent=0)
+    db.session.add(alert)
+    db.session.flush()
+    recipients = select(literal(alert.id), EmergencyAlertUsers.id, literal('pending'), literal(0), literal(now))
+    db.session.execute(insert(AlertDelivery).from_select(
+        ['alert_id', 'alert_user_id', 'status', 'attempts', 'updated_at'], recipients))
+    alert.total_recipients = AlertDelivery.query.filter_by(alert_id=alert.id).count()
+    db.session.commit()
+    launch_broadcast(app, alert.id)
+    return alert
+
+def launch_broadcast(app, alert_id):
+    threading.Thread(target=BroadcastJob(alert_id).run, args=(app,), name=f"broadcast-{alert_id}", daemon=True).start()
+
+# Restarts the broadcasts whose worker died: alerts still 'sending' with no heartbeat for BROADCAST_STALE_SECONDS.
+# Each one is claimed by bumping its heartbeat in a conditional UPDATE, so only one worker resumes it.
+def resume_stale_broadcasts(app):
+    with app.app_context():
+        cutoff = datetime.now() - timedelta(seconds=BROADCAST_STALE_SECONDS)
+        stale_ids = [alert_id for (alert_id,) in db.session.query(EmergencyAlerts.id)
+                     .filter(EmergencyAlerts.status == 'sending', EmergencyAlerts.heartbeat_at < cutoff)]
+        for alert_id in stale_ids:
+            claimed = EmergencyAlerts.query.filter(EmergencyAlerts.id == alert_id, EmergencyAlerts.status == 'sending',
+                                                   EmergencyAlerts.heartbeat_at < cutoff).update(
+                {EmergencyAlerts.heartbeat_at: datetime.now()}, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                print(f"Resuming alert broadcast {alert_id}", file=sys.stderr)
+                launch_broadcast(app, alert_id)
+
+# Checks for stale broadcasts in the background, once per BROADCAST_STALE_SECONDS
+def start_broadcast_resumer(app):
+    if BROADCAST_STALE_SECONDS < 2 * BROADCAST_HEARTBEAT_SECONDS:
+        print(f"BROADCAST_STALE_SECONDS ({BROADCAST_STALE_SECONDS:g}) is less than twice BROADCAST_HEARTBEAT_SECONDS "
+              f"({BROADCAST_HEARTBEAT_SECONDS:g}): running broadcasts may be resumed twice", file=sys.stderr)
+    def run():
+        while True:
+            try:
+                resume_stale_broadcasts(app)
+            except Exception as e:
+                print(f"Error resuming alert broadcasts: {e}", file=sys.stderr)
+            time.sleep(BROADCAST_STALE_SECONDS)
+    threading.Thread(target=run, name="broadcast-resumer", daemon=True).start()
+
+# Progress of a broadcast: recipients by delivery status, and throughput so far
+def broadcast_progress(alert):
+    counts = {status: 0 for status in DELIVERY_STATUSES}
+    for status, count in (db.session.query(AlertDelivery.status, func.count())
+                          .filter_by(alert_id=alert.id).group_by(AlertDelivery.status)):
+        counts[status] = count
+    done = counts['sent'] + counts['failed'] + counts['skipped'] + counts['unknown']
+    end = alert.finished_at or datetime.now()
+    elapsed = (end - alert.started_at).total_seconds() if alert.started_at else 0
+    return {
+        "id": alert.id,
+        "status": alert.status,
+        "started_at": alert.started_at.isoformat() if alert.started_at else None,
+        "finished_at": alert.finished_at.isoformat() if alert.finished_at else None,
+        "total": alert.total_recipients or 0,
+        "counts": counts,
+        "done": done,
+        "elapsed_seconds": round(elapsed, 1),
+        "messages_per_second": round(done / elapsed, 2) if elapsed > 0 else None,
+    }
+
+# Progress of the latest broadcasts, newest first
+def recent_broadcasts(limit=10):
+    alerts = (EmergencyAlerts.query.filter(EmergencyAlerts.started_at.isnot(None))
+              .order_by(EmergencyAlerts.id.desc()).limit(limit).all())
+    return [broadcast_progress(alert) for alert in alerts]
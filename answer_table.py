@@ -0,0 +1,228 @@
+# answer_table.py
+
+"""
+This file contains the precomputed resource answer table.
+There are only about 540 MA zipcodes and a handful of resource categories, so every reply
+geolocate_resources can give is computed ahead of time and served from memory.
+
+Build the table offline with:
+    python answer_table.py
+
+resource_answers.json is committed to the repository, so it ships in the slug and workers never
+need the geo stack to build it. Rebuild and commit it whenever resources_data.csv or the shapefile change.
+
+The table records a fingerprint of the contents of resources_data.csv and the zipcode shapefile. When
+either changes, the table is rebuilt in a background thread and swapped in atomically, without a worker restart.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+from response_content import resource_snippet
+
+# Location of the table, and the sources it is computed from
+ANSWER_TABLE_PATH = os.environ.get("ANSWER_TABLE_PATH", "resource_answers.json")
+RESOURCES_CSV_PATH = "resources_data.csv"
+ZIPCODE_SHAPEFILE_PATH = "./zipcodes_shapefile"
+
+# How often (in seconds) a worker checks whether the table or its sources changed
+ANSWER_TABLE_CHECK_SECONDS = float(os.environ.get("ANSWER_TABLE_CHECK_SECONDS", "30"))
+# Set ANSWER_TABLE_AUTO_REBUILD=0 to only ever load tables built offline.
+# Rebuilding needs the geo stack, so it is off by default when RESOURCE_LOOKUP_MODE=table.
+ANSWER_TABLE_AUTO_REBUILD = os.environ.get("ANSWER_TABLE_AUTO_REBUILD", "0" if os.environ.get("RESOURCE_LOOKUP_MODE") == "table" else "1") != "0"
+
+# Number of resources in each reply
+RESOURCES_PER_REPLY = 5
+
+
+# sha256 of each source file, with the (size, mtime) it was computed at. A file is only read again
+# when its size or mtime changes, so checking the version every ANSWER_TABLE_CHECK_SECONDS stays cheap.
+_file_digests = {}
+
+def _file_digest(path):
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns)
+    cached = _file_digests.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    _file_digests[path] = (key, digest.hexdigest())
+    return digest.hexdigest()
+
+
+# Fingerprint of the resource data and the zipcode shapefile: a hash of their contents.
+# It changes whenever one of the source files does, but not when a git checkout or slug extraction
+# only gives them new mtimes, so a table built offline is still current on every dyno.
+def dataset_version():
+    paths = [RESOURCES_CSV_PATH]
+    if os.path.isdir(ZIPCODE_SHAPEFILE_PATH):
+        paths += sorted(os.path.join(ZIPCODE_SHAPEFILE_PATH, name) for name in os.listdir(ZIPCODE_SHAPEFILE_PATH))
+    fingerprint = hashlib.sha256()
+    for path in paths:
+        try:
+            digest = _file_digest(path)
+        except OSError:
+            continue
+        fingerprint.update(f"{path}:{digest}\n".encode())
+    return fingerprint.hexdigest()
+
+
+# dataset_version(), re-checked at most every ANSWER_TABLE_CHECK_SECONDS. Used as part of cache keys.
+_current_version = None
+_current_version_checked = None
+
+def current_dataset_version():
+    global _current_version, _current_version_checked
+    now = time.monotonic()
+    if _current_version_checked is None or now - _current_version_checked >= ANSWER_TABLE_CHECK_SECONDS:
+        _current_version = dataset_version()
+        _current_version_checked = now
+    return _current_version
+
+
+class AnswerTable:
+    """
+    The precomputed answers, loaded from the JSON file written by build_answer_table().
+    answers[category][zipcode] is a list of [resource_id, inside, distance_miles] entries,
+    and resource_id indexes into resources, a list of [organization_name, address, phone_number].
+    """
+    def __init__(self, data, mtime_ns=None):
+        self.version = data["version"]
+        self.missing_coordinates = data["missing_coordinates"]
+        self.zipcodes = frozenset(data["zipcodes"])
+        self.resources = [tuple(resource) for resource in data["resources"]]
+        # The reply snippet of each resource is formatted once, when the table is loaded
+        self.snippets = [resource_snippet.format(name=name, address=address, phone=phone) for name, address, phone in self.resources]
+        self.answers = data["answers"]
+        self.mtime_ns = mtime_ns
+
+    @classmethod
+    def load(cls, path=ANSWER_TABLE_PATH):
+        mtime_ns = os.stat(path).st_mtime_ns
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f), mtime_ns)
+
+    def has_category(self, resource_category):
+        return resource_category in self.answers
+
+    def has_zipcode(self, zipcode):
+        return str(zipcode) in self.zipcodes
+
+    def lookup(self, resource_category, zipcode):
+        """Return (snippet, inside, distance_miles) tuples for a category and zipcode."""
+        entries = self.answers.get(resource_category, {}).get(str(zipcode), [])
+        return [(self.snippets[resource_id], inside, distance_miles) for resource_id, inside, distance_miles in entries]
+
+
+# Computes every (category, zipcode) answer and writes the table.
+# The file is written to a temporary path first and moved into place, so readers never see half a table.
+def build_answer_table(path=ANSWER_TABLE_PATH):
+    # The geo stack is only needed to build the table, not to serve it
+    from geo_index import ZipIndex, ResourceIndex, rank_resources
+
+    # Fingerprint the sources before reading them, so a change made during the build triggers another one
+    version = dataset_version()
+    zip_index = ZipIndex()
+    resource_index = ResourceIndex()
+
+    resources = []
+    answers = {}
+    for resource_category, category_index in resource_index.categories.items():
+        # Give every resource in the category an id in the shared resources list
+        first_id = len(resources)
+        for _, row in category_index.rows.iterrows():
+            resources.append([f"{row.get('organization_name', 'N/A')}", f"{row.get('address', 'N/A')}", f"{row.get('phone_number', 'N/A')}"])
+        category_answers = {}
+        for zipcode in zip_index.polygons:
+            ranked = rank_resources(category_index, zip_index.polygon(zipcode), zip_index.centroid(zipcode), RESOURCES_PER_REPLY)
+            category_answers[zipcode] = [[first_id + position, inside, distance_miles] for position, inside, distance_miles in ranked]
+        answers[resource_category] = category_answers
+
+    data = {
+        "version": version,
+        "missing_coordinates": resource_index.missing_coordinates,
+        "zipcodes": sorted(zip_index.polygons),
+        "resources": resources,
+        "answers": answers,
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+    return AnswerTable.load(path)
+
+
+# The table currently being served, swapped as a whole when a new one is loaded
+_answer_table = None
+_last_check = None
+_reload_lock = threading.Lock()
+_rebuild_thread = None
+
+# Rebuilds the table in a background thread. A lock file stops several workers from rebuilding at once.
+def _start_rebuild(path):
+    global _rebuild_thread
+    if _rebuild_thread is not None and _rebuild_thread.is_alive():
+        return
+    lock_path = path + ".lock"
+    try:
+        # A lock left behind by a crashed worker is ignored after 10 minutes
+        if time.time() - os.stat(lock_path).st_mtime > 600:
+            os.remove(lock_path)
+    except OSError:
+        pass
+    try:
+        lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return
+    os.close(lock_fd)
+
+    def rebuild():
+        global _answer_table
+        try:
+            _answer_table = build_answer_table(path)
+        except Exception as e:
+            print(f"Error rebuilding the resource answer table: {e}", file=sys.stderr)
+        finally:
+            os.remove(lock_path)
+
+    _rebuild_thread = threading.Thread(target=rebuild, name="answer-table-rebuild", daemon=True)
+    _rebuild_thread.start()
+
+# Returns the current answer table, or None if there isn't one yet.
+# At most every ANSWER_TABLE_CHECK_SECONDS, it reloads the table if the file changed
+# and starts a rebuild if the resource data or shapefile changed.
+def get_answer_table(path=ANSWER_TABLE_PATH):
+    global _answer_table, _last_check
+    now = time.monotonic()
+    if _last_check is not None and now - _last_check < ANSWER_TABLE_CHECK_SECONDS:
+        return _answer_table
+    with _reload_lock:
+        if _last_check is not None and now - _last_check < ANSWER_TABLE_CHECK_SECONDS:
+            return _answer_table
+        _last_check = now
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        # Another worker (or the offline build) wrote a new table
+        if mtime_ns is not None and (_answer_table is None or _answer_table.mtime_ns != mtime_ns):
+            try:
+                _answer_table = AnswerTable.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error loading the resource answer table: {e}", file=sys.stderr)
+        # The sources changed since the table was built (or there is no table yet)
+        if ANSWER_TABLE_AUTO_REBUILD and (_answer_table is None or _answer_table.version != dataset_version()):
+            _start_rebuild(path)
+        return _answer_table
+
+
+# Offline build step
+if __name__ == "__main__":
+    table = build_answer_table()
+    print(f"Wrote {ANSWER_TABLE_PATH}: {len(table.zipcodes)} zipcodes, {len(table.answers)} categories, {len(table.resources)} resources")
@@ -6,6 +6,12 @@ from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
 from database import db
+from db_pool import engine_options, pool_monitor
+from metrics import request_metrics
+from query_budget import query_budget
+from event_writer import event_writer
+from session_store import session_write_behind
+from deferred_replies import deferred_replies
 
 # Create the Flask application
 app = Flask(__name__)
@@ -15,12 +21,24 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL').replace('
 # secret key
 app.secret_key = os.environ.get('SECRET_KEY')
 
+# Connection pool sizing, pre-ping, recycling and statement timeout, configured from the environment (see db_pool.py)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+
 # Initialize the database
 db.init_app(app)
+# Count connections, pool waits and queries per request, for the admin health endpoint
+pool_monitor.init_app(app)
+# Latency histograms of web requests and SQL statements, served on /metrics
+request_metrics.init_app(app)
+# With SQL_QUERY_BUDGET=warn or enforce, each SMS message's statements and commits are checked against its state's budget
+query_budget.init_app(app)
+# The buffered event writer, the session write-behind and the deferred-reply workers
+# need the app to open their own database connections
+event_writer.init_app(app)
+session_write_behind.init_app(app)
+deferred_replies.init_app(app)
 
-# Load and cache the data at startup
-resources_data = None
-# Load and cache the data at startup
+# Create the tables at startup
 with app.app_context():
     # The db.drop_all() is commented out to prevent accidental database drops.
     # Uncomment it only when you need to drop and recreate the tables, during development.
@@ -28,6 +46,19 @@ with app.app_context():
     # Create all tables if database does not exist
     db.create_all()  # Create all tables if database does not exist
 
+# The geographic indexes are built lazily on the first resource lookup.
+# Set PRELOAD_GEO_INDEXES=1 to build them at startup instead (pairs well with gunicorn --preload).
+if os.environ.get('PRELOAD_GEO_INDEXES') == '1':
+    from geo_index import preload_geo_indexes
+    preload_geo_indexes()
+
+# Alert broadcasts whose worker died (a deploy or a dyno restart) are resumed from their delivery ledger.
+# Every worker checks; a conditional UPDATE makes sure only one of them picks up each broadcast.
+# Set BROADCAST_RESUME=0 to turn this off. Not compatible with gunicorn --preload, whose workers don't inherit the thread.
+if os.environ.get('BROADCAST_RESUME', '1') != '0':
+    from alert_broadcast import start_broadcast_resumer
+    start_broadcast_resumer(app)
+
 # Set up rate limiting for the application
 limiter = Limiter(key_func=get_remote_address, app=app)
 
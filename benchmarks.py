@@ -0,0 +1,283 @@
+# benchmarks.py
+
+"""
+Microbenchmarks for the code on the path of every inbound SMS, and a regression gate.
+
+Usage:
+    python benchmarks.py run [--save benchmark_baseline.json] [--filter NAME]
+    python benchmarks.py compare [--baseline benchmark_baseline.json] [--threshold 0.25] [--results FILE]
+
+`run` times each benchmark and prints the median time per call. `compare` runs them again (or reads
+the results saved by `run --save`) and fails if any benchmark got slower than its baseline by more
+than the threshold (0.25 = 25% slower). The baseline is only meaningful on the machine it was recorded
+on, so record it (`run --save benchmark_baseline.json`) and compare on the same machine.
+
+The benchmarks cover the resource lookup (cold: reply cache cleared before every call, and warm),
+fuzzy and menu matching, phone number hashing, creating an event, and handling one message in each
+conversation state. The database benchmarks run in-process against a throwaway SQLite database,
+never against DATABASE_URL. Each message is rolled back after it's timed, so every call starts from
+the same state.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+
+# Default file the baseline is saved to and compared against
+DEFAULT_BASELINE_PATH = "benchmark_baseline.json"
+# A benchmark fails the comparison when it is this much slower than its baseline (0.25 = 25%)
+DEFAULT_THRESHOLD = float(os.environ.get("BENCHMARK_THRESHOLD", "0.25"))
+# Each benchmark is timed this many times, and the median is kept
+ROUNDS = 5
+
+# Phone numbers are hashed with a throwaway salt unless one is set
+os.environ.setdefault("FIXED_SALT", "benchmarks")
+
+# Name -> (prepare, calls per round). prepare() returns the function to time, or a
+# (function, setup) pair where setup() runs before every call, outside the timing.
+BENCHMARKS = {}
+
+def benchmark(name, calls=1000):
+    def register(prepare):
+        BENCHMARKS[name] = (prepare, calls)
+        return prepare
+    return register
+
+
+# The test app, created on first use with a throwaway SQLite database
+_app = None
+
+def test_app():
+    global _app
+    if _app is None:
+        directory = tempfile.mkdtemp(prefix="benchmarks-")
+        atexit.register(shutil.rmtree, directory, ignore_errors=True)
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'benchmarks.db')}"
+        os.environ["BROADCAST_RESUME"] = "0"
+        os.environ.setdefault("SECRET_KEY", "benchmarks")
+        from app import app
+        app.app_context().push()
+        _app = app
+    return _app
+
+
+# Resource lookup, with the answer table if there is one, or the geographic indexes
+RESOURCE_CATEGORY = "Syringe Service Program"
+ZIPCODE = "02139"
+
+@benchmark("geolocate_resources (cold)", calls=50)
+def bench_geolocate_cold():
+    from chatbot_utils import geolocate_resources, resource_reply_cache
+    # The first lookup loads the indexes, which isn't what's measured here
+    geolocate_resources(RESOURCE_CATEGORY, ZIPCODE)
+    return lambda: geolocate_resources(RESOURCE_CATEGORY, ZIPCODE), resource_reply_cache.clear
+
+@benchmark("geolocate_resources (warm)", calls=10000)
+def bench_geolocate_warm():
+    from chatbot_utils import geolocate_resources
+    geolocate_resources(RESOURCE_CATEGORY, ZIPCODE)
+    return lambda: geolocate_resources(RESOURCE_CATEGORY, ZIPCODE)
+
+
+# Matching replies
+@benchmark("typos_check", calls=10000)
+def bench_typos_check():
+    from chatbot_utils import typos_check
+    return lambda: typos_check("harm reducton resources", "Harm Reduction Resources")
+
+@benchmark("menu matching (exact)", calls=10000)
+def bench_menu_exact():
+    from intent_matcher import MAIN_MENU_INTENTS
+    return lambda: MAIN_MENU_INTENTS.match("1")
+
+@benchmark("menu matching (fuzzy)", calls=10000)
+def bench_menu_fuzzy():
+    from intent_matcher import RESOURCE_MENU_INTENTS
+    return lambda: RESOURCE_MENU_INTENTS.match("naloxone and overdose trainin")
+
+
+# Phone number hashing. Uncached cycles through more numbers than the cache holds, so every call misses.
+@benchmark("hash_phone_number (cached)", calls=10000)
+def bench_hash_cached():
+    from chatbot_utils import hash_phone_number
+    return lambda: hash_phone_number("+15555550100")
+
+@benchmark("hash_phone_number (uncached)", calls=10000)
+def bench_hash_uncached():
+    from chatbot_utils import hash_phone_number
+    from phone_hashing import phone_number_hasher
+    phone_numbers = [f"+1555{i:07d}" for i in range(phone_number_hasher.cache_size * 2)]
+    position = iter(range(sys.maxsize))
+    return lambda: hash_phone_number(phone_numbers[next(position) % len(phone_numbers)])
+
+
+@benchmark("create_event", calls=1000)
+def bench_create_event():
+    test_app()
+    from database import db
+    from event_handlers import create_event
+    return lambda: create_event("benchmarks", "sms_received", session_id=1), db.session.rollback
+
+
+# One message in each conversation state: (message, session fields the state expects)
+STATE_MESSAGES = {
+    "PRE-REGISTRATION": ("hi", {}),
+    "REGISTRATION": ("yes", {}),
+    "ASK_RACE_ETHNICITY": ("4", {}),
+    "ASK_MULTIRACIAL1": ("1", {}),
+    "ASK_MULTIRACIAL2": ("3", {}),
+    "ASK_GENDER": ("1", {}),
+    "ASK_GENDER_OTHER": ("nonbinary", {}),
+    "ASK_AGE_GROUP": ("3", {}),
+    "MAIN_MENU": ("2", {}),
+    "RETURNING_USER": ("hi", {}),
+    "RESOURCE_MENU": ("1", {}),
+    "ZIPCODE_INPUT": (ZIPCODE, {"resource_category": RESOURCE_CATEGORY}),
+    "RESOURCE_VIEW": ("*", {"resource_category": RESOURCE_CATEGORY}),
+    "HELPLINE_MENU": ("1", {}),
+    "HELPLINE_VIEW": ("*", {"helpline_program": "SafeSpot"}),
+    "NEW_ALERTS_USER": ("add", {}),
+    "EXISTING_ALERTS_USER": ("latest", {}),
+}
+BENCHMARK_PHONE_NUMBER = "+15555550199"
+
+# Times conversation.handle() in a state, plus flushing what it changed, like one /sms request
+def state_benchmark(state, body, fields):
+    def prepare():
+        test_app()
+        from database import db, unit_of_work
+        from chatbot_utils import hash_phone_number, check_create_user, create_user_session
+        from session_store import SessionState
+        from state_handlers import conversation
+        hashed_phone_number = hash_phone_number(BENCHMARK_PHONE_NUMBER)
+        with unit_of_work():
+            check_create_user(hashed_phone_number)
+            session_id = create_user_session(hashed_phone_number, None).id
+        user_session = None
+
+        def setup():
+            nonlocal user_session
+            db.session.rollback()
+            user_session = SessionState(id=session_id, hashed_phone_number=hashed_phone_number, state=state, **fields)
+
+        def handle():
+            conversation.handle(user_session, hashed_phone_number, BENCHMARK_PHONE_NUMBER, body)
+            db.session.flush()
+        return handle, setup
+    return prepare
+
+for _state, (_body, _fields) in STATE_MESSAGES.items():
+    benchmark(f"state {_state}", calls=200)(state_benchmark(_state, _body, _fields))
+
+
+# Times one benchmark, and returns the median time per call in microseconds
+def measure(name):
+    prepare, calls = BENCHMARKS[name]
+    prepared = prepare()
+    function, setup = prepared if isinstance(prepared, tuple) else (prepared, None)
+    rounds = []
+    for _ in range(ROUNDS):
+        if setup is None:
+            start = time.perf_counter()
+            for _ in range(calls):
+                function()
+            elapsed = time.perf_counter() - start
+        else:
+            elapsed = 0.0
+            for _ in range(calls):
+                setup()
+                start = time.perf_counter()
+                function()
+                elapsed += time.perf_counter() - start
+        rounds.append(elapsed / calls * 1e6)
+    return {"median_us": round(statistics.median(rounds), 3), "min_us": round(min(rounds), 3), "calls": calls}
+
+
+def run(name_filter=None):
+    results = {}
+    for name in BENCHMARKS:
+        if name_filter and name_filter not in name:
+            continue
+        try:
+            results[name] = measure(name)
+        except Exception as e:
+            print(f"  {name}: failed ({type(e).__name__}: {e})", file=sys.stderr)
+            continue
+        print(f"  {results[name]['median_us']:12.2f} us  {name}")
+    return {"python": platform.python_version(), "machine": platform.node(), "results": results}
+
+
+def compare(baseline, current, threshold):
+    """Prints each benchmark against its baseline, and returns the names of the ones that regressed."""
+    regressions = []
+    print(f"{'benchmark':<40}{'baseline us':>14}{'current us':>14}{'change':>10}")
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            print(f"{name:<40}{'-':>14}{result['median_us']:>14.2f}{'new':>10}")
+            continue
+        before = baseline["results"][name]["median_us"]
+        change = result["median_us"] / before - 1 if before else 0.0
+        flag = "  REGRESSED" if change > threshold else ""
+        print(f"{name:<40}{before:>14.2f}{result['median_us']:>14.2f}{change:>+10.0%}{flag}")
+        if change > threshold:
+            regressions.append(name)
+    for name in baseline["results"]:
+        if name not in current["results"]:
+            print(f"{name:<40}{'':>14}{'missing':>14}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the microbenchmarks, or compare them with a baseline.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--save", help="save the results to this file (for example as the baseline)")
+    run_parser.add_argument("--filter", help="only run the benchmarks whose name contains this")
+    compare_parser = commands.add_parser("compare", help="fail if a benchmark regressed past the threshold")
+    compare_parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH)
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown (0.25 = 25%%)")
+    compare_parser.add_argument("--results", help="compare these saved results instead of running the benchmarks")
+    compare_parser.add_argument("--filter", help="only run the benchmarks whose name contains this")
+    args = parser.parse_args()
+
+    # The resource data and shapefile paths are relative to the project, the paths given here to the current directory
+    for path in ("save", "baseline", "results"):
+        if getattr(args, path, None):
+            setattr(args, path, os.path.abspath(getattr(args, path)))
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    if args.command == "run":
+        results = run(args.filter)
+        if args.save:
+            with open(args.save, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            print(f"\nSaved to {args.save}")
+        return
+
+    if not os.path.exists(args.baseline):
+        sys.exit(f"No baseline at {args.baseline}. Record one with: python benchmarks.py run --save {args.baseline}")
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if args.results:
+        with open(args.results, encoding="utf-8") as f:
+            current = json.load(f)
+    else:
+        current = run(args.filter)
+        print()
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print(f"\nFAILED: {len(regressions)} benchmark(s) more than {args.threshold:.0%} slower than the baseline:\n  "
+              + "\n  ".join(regressions))
+        sys.exit(1)
+    print("\nOK")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,15 @@
-from flask import Blueprint, request
-from twilio.twiml.messaging_response import MessagingResponse
-from database import db, SMSUserSession
-from chatbot_utils import check_create_user, is_session_expired, create_user_session, hash_phone_number
+import time
+from datetime import datetime
+from flask import Blueprint, g, has_request_context, request
+from user_serialization import user_unit_of_work
+from chatbot_utils import check_create_user, get_latest_session, is_session_expired, create_user_session, hash_phone_number
 from event_handlers import event_sms_received
-from state_handlers import (state_PRE_REGISTRATION, state_REGISTRATION, state_ASK_RACE_ETHNICITY,
-                            state_ASK_MULTIRACIAL1, state_ASK_MULTIRACIAL2, state_ASK_GENDER, state_ASK_GENDER_OTHER,state_ASK_AGE_GROUP,
-                            state_MAIN_MENU, state_RESOURCE_MENU, state_RESOURCE_VIEW, state_ZIPCODE_INPUT, state_HELPLINE_MENU, state_HELPLINE_VIEW,
-                            state_NEW_ALERTS_USER, state_EXISTING_ALERTS_USER, state_RETURNING_USER)
+from session_store import session_store, session_write_behind, SessionState
+from state_handlers import conversation
+from deferred_replies import SMS_DEFERRED_REPLIES, deferred_replies, empty_twiml
+from metrics import message_seconds, state_seconds, phase_seconds
+from profiler import request_profiler
+from query_budget import query_budget
 
 chatbot_blueprint = Blueprint('chatbot', __name__)
 
@@ -14,56 +17,81 @@ chatbot_blueprint = Blueprint('chatbot', __name__)
 def sms_reply():
      # Extract phone number and message body from the request
     phone_number = request.values.get('From', None)
-    hashed_phone_number = hash_phone_number(phone_number)
     body = request.values.get('Body', None)
 
+    # In deferred-reply mode Twilio gets an empty response right away, and the reply is sent by a worker
+    if SMS_DEFERRED_REPLIES:
+        deferred_replies.enqueue(phone_number, body)
+        return empty_twiml
+    reply = process_message(phone_number, body)
+    # The state the message was handled in, so a load test (load_test.py) can tell whether it stayed on script
+    return reply, 200, {"X-Conversation-State": g.get("conversation_state", "")}
+
+# Handles one inbound message: moves the user's conversation on and returns the TwiML reply.
+# Called by the webhook, or by a deferred-reply worker. A fraction of the messages is profiled (see profiler.py).
+@request_profiler.sample
+@query_budget.guard
+def process_message(phone_number, body):
+    start = time.perf_counter()
+    hashed_phone_number = hash_phone_number(phone_number)
+
     # Convert the body to lowercase to ensure consistent processing
     if body is not None:
         body = body.lower()
 
-    # Check if the user exists in the database, and create a new user if they don't
-    check_create_user(hashed_phone_number)
+    # Everything this message changes (user, session, events) is committed in one transaction
+    # when the block exits, and rolled back if anything in it fails.
+    # With SMS_SERIALIZE_USERS on, the user's other messages wait until this one is done.
+    try:
+        with user_unit_of_work(hashed_phone_number) as session:
+            with phase_seconds.time("session"):
+                # With a session store configured, an active conversation is read from the store.
+                # A hit means the session hasn't expired and the user exists, so the database isn't touched.
+                user_session = session_store.get(hashed_phone_number) if session_store is not None else None
+                if user_session is not None:
+                    user_session.last_interaction = datetime.now()
+                else:
+                    # Check if the user exists in the database, and create a new user if they don't
+                    check_create_user(hashed_phone_number)
+
+                    # Get the user's latest session, or None if they've never had one
+                    user_session = get_latest_session(hashed_phone_number)
+
+                    # If the session doesn't exist (None) or is expired, create a new session.
+                    # The session just looked up decides where the new one starts, so it isn't queried again.
+                    if not user_session or is_session_expired(user_session):
+                        user_session = create_user_session(hashed_phone_number, user_session)
+
+                    # From here on the conversation state is kept in the store, and written behind to the database
+                    if session_store is not None:
+                        user_session = SessionState.from_row(user_session)
+
+            # Log the SMS received event
+            event_sms_received(hashed_phone_number, user_session.id)
+
+            # Handle the message in the conversation's current state (see state_handlers.py for the states)
+            state = user_session.state
+            query_budget.label_state(state)
+            if has_request_context():
+                g.conversation_state = state
+            with state_seconds.time(state):
+                reply = conversation.handle(user_session, hashed_phone_number, phone_number, body)
 
-    # Get the user's session. If the session is expired the query will return None.
-    user_session = SMSUserSession.query.filter_by(hashed_phone_number=hashed_phone_number).order_by(SMSUserSession.last_interaction.desc()).first()
-    
-    # If the session doesn't exist (None) or is expired, create a new session.
-    if not user_session or is_session_expired(user_session):
-        user_session = create_user_session(hashed_phone_number)
+            # With SQL_QUERY_BUDGET on, check the message's queries before committing (see query_budget.py)
+            query_budget.check(session)
 
-    # Log the SMS received event
-    event_sms_received(hashed_phone_number, user_session.id)
-    db.session.commit()
+            # Save the new state to the store as the last step of the transaction, while the user is still
+            # serialized, so their next message reads it. The sessions table gets it from the write-behind.
+            if session_store is not None:
+                session_store.put(user_session)
+    except Exception:
+        # The transaction rolled back, so the store mustn't keep a state the database never saw
+        if session_store is not None:
+            session_store.delete(hashed_phone_number)
+        raise
 
-    # Use a dictionary to map states to their handler functions
-    state_handlers = {
-        "PRE-REGISTRATION": state_PRE_REGISTRATION,
-        "REGISTRATION": state_REGISTRATION,
-        "ASK_RACE_ETHNICITY": state_ASK_RACE_ETHNICITY,
-        "ASK_MULTIRACIAL1": state_ASK_MULTIRACIAL1,
-        "ASK_MULTIRACIAL2": state_ASK_MULTIRACIAL2,
-        "ASK_GENDER": state_ASK_GENDER,
-        "ASK_GENDER_OTHER": state_ASK_GENDER_OTHER,
-        "ASK_AGE_GROUP": state_ASK_AGE_GROUP,
-        "MAIN_MENU": state_MAIN_MENU,
-        "RETURNING_USER": state_RETURNING_USER,
-        "RESOURCE_MENU": state_RESOURCE_MENU,
-        "ZIPCODE_INPUT": state_ZIPCODE_INPUT,
-        "RESOURCE_VIEW": state_RESOURCE_VIEW,
-        "HELPLINE_MENU": state_HELPLINE_MENU,
-        "HELPLINE_VIEW": state_HELPLINE_VIEW,
-        "NEW_ALERTS_USER": state_NEW_ALERTS_USER,
-        "EXISTING_ALERTS_USER": state_EXISTING_ALERTS_USER,
-    }
-    # Call the appropriate state handler function
-    if user_session.state in state_handlers:
-        return state_handlers[user_session.state](user_session, hashed_phone_number, body)
-        """In the above code, user_session.state is the current state of the conversation
-        # This code uses the current state as the key to look up the corresponding function in the state_handlers dictionary
-        # Then it calls that function with the user_session, hashed_phone_number, and body as arguments
-        """
-    else:
-        # Handle unknown state. This shouldn't happen, but it's good to have a fallback.
-        resp = MessagingResponse()
-        resp.message("An error occurred. Please try again later.")
-        return str(resp)
\ No newline at end of file
+    if session_store is not None:
+        session_write_behind.enqueue(user_session)
+    # Includes committing the transaction
+    message_seconds.observe(time.perf_counter() - start, state)
+    return reply
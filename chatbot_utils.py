@@ -5,49 +5,65 @@ from database import db, SMSUser, SMSUserSession, EmergencyAlertUsers
 from event_handlers import event_create_user, event_session_created
 from response_content import emoji_dict, more_resources, resource_view_boilerplate
 from rapidfuzz import fuzz
-from response_content import not_subscribed_to_alerts_boilerplate, already_subscribed_to_alerts_boilerplate
+from response_content import not_signed_up_for_alerts, already_signed_up_for_alerts, zipcode_not_found
+from response_content import resource_inside_zipcode, resource_distance, resource_lookup_unavailable
 import os
-import hashlib
-import pandas as pd
-import geopandas as gpd
-
-# Loading the resource data from the csv file
-df = pd.read_csv("resources_data.csv")
+from phone_hashing import phone_number_hasher
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from answer_table import get_answer_table, current_dataset_version
+from reply_cache import ReplyCache
+from metrics import timed, phase_seconds
 
 # Phone Number Hashing Function
 # Hashes the phone number to a unique identifier
 def hash_phone_number(phone_number):
     # (A fixed salt adds an additional layer of security and uniqueness to the hashed phone number)
-    salt = os.environ.get("FIXED_SALT")
-    salted_phone_number = salt.encode() + phone_number.encode()
-    return hashlib.sha256(salted_phone_number).hexdigest()
+    # The salt is loaded once, and recent numbers are cached (see phone_hashing.py)
+    return phone_number_hasher.hash(phone_number)
 
 # User Management Function
 def check_create_user(hashed_phone_number):
-    user = SMSUser.query.get(hashed_phone_number)
-    # Checks if the user exists in the database, and creates a new user if they don't
-    if not user:
-        user = SMSUser(hashed_phone_number=hashed_phone_number, first_interaction=datetime.now())
-        db.session.add(user)
-        db.session.commit()
-        event_create_user(hashed_phone_number)
-        db.session.commit()
-    return user 
+    user = db.session.get(SMSUser, hashed_phone_number)
+    if user:
+        return user
+    # Creates the user if they don't exist yet. Two messages from a new user can get here at the same time,
+    # so the row is inserted with ON CONFLICT DO NOTHING: only the one that actually inserts it logs create_user,
+    # and the other one doesn't fail with a duplicate key. The insert also makes the user row exist before
+    # the events that reference it.
+    dialect = db.session.get_bind().dialect.name
+    if dialect in upsert_inserts:
+        result = db.session.execute(upsert_inserts[dialect](SMSUser.__table__)
+                                    .values(hashed_phone_number=hashed_phone_number, first_interaction=datetime.now())
+                                    .on_conflict_do_nothing(index_elements=['hashed_phone_number']))
+        if result.rowcount == 1:
+            event_create_user(hashed_phone_number)
+        return db.session.get(SMSUser, hashed_phone_number)
+    user = SMSUser(hashed_phone_number=hashed_phone_number, first_interaction=datetime.now())
+    db.session.add(user)
+    db.session.flush()
+    event_create_user(hashed_phone_number)
+    return user
+
+# The INSERT ... ON CONFLICT constructs of the databases that have one
+upsert_inserts = {"postgresql": postgresql_insert, "sqlite": sqlite_insert}
 
 # Session Management Functions
 def is_session_expired(user_session):
     # Check if the user session is expired based on the last interaction time
     if datetime.now() - user_session.last_interaction <= timedelta(minutes=30):
         user_session.last_interaction = datetime.now()
-        db.session.commit()
         return False
     return True
  
-def create_user_session(hashed_phone_number):
-    # Attempt to retrieve an existing session for the hashed phone number
-    user_session = SMSUserSession.query.filter_by(hashed_phone_number=hashed_phone_number).order_by(SMSUserSession.last_interaction.desc()).first()
+# Returns the user's most recent session, or None. Served by the (hashed_phone_number, last_interaction) index.
+def get_latest_session(hashed_phone_number):
+    return SMSUserSession.query.filter_by(hashed_phone_number=hashed_phone_number).order_by(SMSUserSession.last_interaction.desc()).first()
+
+# previous_session is the user's latest session (or None), which the caller has already looked up
+def create_user_session(hashed_phone_number, previous_session):
     # Check the existing user session; decide on the state based on its current state or lack thereof
-    if user_session is None or user_session.state in ["REGISTRATION", "OPT-OUT", "ASK_RACE_ETHNICITY", "ASK_MULTIRACIAL1", "ASK_MULTIRACIAL2", "ASK_GENDER", "ASK_GENDER_OTHER", "ASK_AGE_GROUP"]:
+    if previous_session is None or previous_session.state in ["REGISTRATION", "OPT-OUT", "ASK_RACE_ETHNICITY", "ASK_MULTIRACIAL1", "ASK_MULTIRACIAL2", "ASK_GENDER", "ASK_GENDER_OTHER", "ASK_AGE_GROUP"]:
         # If no session found or the user previously did not complete the registration process-
         # start a new session with the pre-registration state (they start registration over)
         state = "PRE-REGISTRATION"
@@ -60,12 +76,11 @@ def create_user_session(hashed_phone_number):
         state=state,
         last_interaction=datetime.now()
     )
-    # Add the new session to the database and commit changes
+    # Add the new session to the database. Flushing assigns its id without committing.
     db.session.add(new_user_session)
-    db.session.commit()
+    db.session.flush()
     # Log the event of session creation
     event_session_created(hashed_phone_number, new_user_session.id)
-    db.session.commit()
     return new_user_session
 
 # Alert Management Function
@@ -76,16 +91,14 @@ def emergency_alerts_checker(phone_number, user_session):
     if alert_user is None:
         # Set the user's session state to 'NEW_ALERTS_USER'
         user_session.state = 'NEW_ALERTS_USER'
-        db.session.commit()
         # Return the message indicating the user is not signed up for emergency alerts
-        return ("You are not signed up for emergency alerts.\n\n" + not_subscribed_to_alerts_boilerplate) 
+        return not_signed_up_for_alerts
     # If the user is in the table, they are an existing alerts user
     else:
         # Set the user's session state to 'EXISTING_ALERTS_USER'
         user_session.state = 'EXISTING_ALERTS_USER'
-        db.session.commit()
         # Return the message indicating the user is already signed up for emergency alerts
-        return ("You are already signed up for emergency alerts.\n\n" + already_subscribed_to_alerts_boilerplate)
+        return already_signed_up_for_alerts
 
 # Input Processing Functions
 def typos_check(a, b, ratio=85):
@@ -95,87 +108,76 @@ def typos_check(a, b, ratio=85):
     """
     return fuzz.ratio(a.lower(), b.lower()) > ratio
 
+# "table" serves resource replies only from the precomputed answer table, so the geo stack
+# (pandas, geopandas, shapely, pyproj) is never imported by the web workers.
+# "auto" falls back to the geographic indexes when there is no answer table.
+RESOURCE_LOOKUP_MODE = os.environ.get("RESOURCE_LOOKUP_MODE", "auto")
+
+# Cache of rendered resource replies, keyed on (category, zipcode, dataset version) so that
+# a change to the resource data or the shapefile never serves an old reply
+resource_reply_cache = ReplyCache(maxsize=int(os.environ.get("RESOURCE_CACHE_SIZE", "1024")),
+                                  ttl=float(os.environ.get("RESOURCE_CACHE_TTL", "3600")))
+
+@timed(phase_seconds, "resource_lookup")
 def geolocate_resources(resource_category, zipcode):
-    # Filter for resources matching the category
-    filtered_df = df[df['resource_category'] == resource_category].copy()
-    
+    key = (resource_category, str(zipcode), current_dataset_version())
+    # Replies from a failed zipcode data load are not cached, so the next lookup retries
+    return resource_reply_cache.get_or_compute(key, lambda: lookup_resources(resource_category, zipcode),
+                                               should_cache=lambda reply: not reply.startswith("Error loading zipcode data") and reply != resource_lookup_unavailable)
+
+# Timed separately: these are the cache misses, and the first one loads the geographic indexes
+@timed(phase_seconds, "resource_compute")
+def lookup_resources(resource_category, zipcode):
+    # Serve from the precomputed answer table when there is one
+    answer_table = get_answer_table()
+    if answer_table is not None:
+        # Ensure the resource data had longitude and latitude columns
+        if answer_table.missing_coordinates:
+            return "⚠️Resource data missing longitude and latitude columns. Notify the chatbot administrator there's an issue with the dataset."
+        # Check if any resources found for this category
+        if not answer_table.has_category(resource_category):
+            return f" ⚠️ No {resource_category} resources found in the database. Check with the chatbot administrator."
+        if not answer_table.has_zipcode(zipcode):
+            return f"ERROR - {zipcode_not_found.format(zipcode=zipcode)}"
+        return render_resources(resource_category, zipcode, answer_table.lookup(resource_category, zipcode))
+    if RESOURCE_LOOKUP_MODE == "table":
+        return resource_lookup_unavailable
+
+    # Otherwise compute the answer from the preloaded geographic indexes.
+    # The geo stack is imported here rather than at the top of the file, to keep it out of worker boot.
+    from geo_index import get_zip_index, get_resource_index, rank_resources
+    resource_index = get_resource_index()
+
+    # Ensure the resource data has longitude and latitude columns
+    if resource_index.missing_coordinates:
+        return "⚠️Resource data missing longitude and latitude columns. Notify the chatbot administrator there's an issue with the dataset."
+
     # Check if any resources found for this category
-    if filtered_df.empty:
+    category_index = resource_index.category(resource_category)
+    if category_index is None:
         return f" ⚠️ No {resource_category} resources found in the database. Check with the chatbot administrator."
-    
-    # Ensure filtered_df has longitude and latitude columns
-    if 'longitude' not in filtered_df.columns or 'latitude' not in filtered_df.columns:
-        return "⚠️Resource data missing longitude and latitude columns. Notify the chatbot administrator there's an issue with the dataset."    
-    # Constants
-    LL_CRS = "EPSG:4326"      # lon/lat WGS-84
-    MA_SPCS = "EPSG:26986"    # NAD83 / Massachusetts Mainland - metres
-    
-    def build_gdfs(df, zip_path, zipcode):
-        """
-        Return (resources_gdf, zip_polygon_gdf) in the SAME projected CRS.
-        Raises if zipcode not found.
-        """
-        # --- 1. ZIP polygons ---------------------------------------------------- #
-        zip_gdf = gpd.read_file(zip_path)
-
-        target_zip = zip_gdf.loc[zip_gdf["POSTCODE"] == str(zipcode)]
-        if target_zip.empty:
-            raise ValueError(f"⚠️ MA zipcode {zipcode} not found in shapefil. Check with the chatbot administrator if there's an issue.")
-
-        # project once and cache
-        target_zip = target_zip.to_crs(MA_SPCS)
-
-        # --- 2. Resource points ------------------------------------------------- #
-        # create points in lon/lat
-        points_ll = gpd.GeoDataFrame(
-            df,
-            geometry=gpd.points_from_xy(df["longitude"], df["latitude"]),
-            crs=LL_CRS,
-        ).to_crs(MA_SPCS)          # re-project to same CRS as ZIPs
-
-        return points_ll, target_zip
 
     try:
-        resources_gdf, target_zip_gdf = build_gdfs(filtered_df, "./zipcodes_shapefile", zipcode)
+        # ZIP polygons come from the preloaded, projected index
+        zip_index = get_zip_index()
+        zip_polygon = zip_index.polygon(zipcode)
+        # Distance is measured from the ZIP centroid
+        zip_centroid = zip_index.centroid(zipcode)
     except ValueError as exc:
         return f"ERROR - {exc}"
     except Exception as e:
         return f"Error loading zipcode data: {str(e)}"
 
-    zip_polygon = target_zip_gdf.geometry.iloc[0]
-    
-    # Distance from ZIP centroid for all rows
-    zip_centroid = zip_polygon.centroid
-    resources_gdf["distance_miles"] = resources_gdf.distance(zip_centroid) * 0.000621371
-    
-    # Now build the inside / outside subsets
-    inside_mask = resources_gdf.within(zip_polygon)
-    inside_resources = resources_gdf.loc[inside_mask]
-    outside_resources = resources_gdf.loc[~inside_mask]
-    
-    # Build response string starting with resources inside zipcode
-    response = f"Here are the closest {resource_category} resources to {zipcode}:\n\n---\n"
-    
-    # Add resources inside zipcode
-    for _, row in inside_resources.iterrows():
-        name = row.get('organization_name', 'N/A')
-        address = row.get('address', 'N/A')
-        phone = row.get('phone_number', 'N/A')
-        response += f"{name}\n{address}\n{phone}\nEstimated distance: inside zipcode {zipcode}\n---\n"
-    
-    # Calculate how many more resources we need
-    remaining_count = 5 - len(inside_resources)
-    
-    if remaining_count > 0 and not outside_resources.empty:
-        # Get the closest outside resources
-        closest_outside = outside_resources.nsmallest(remaining_count, 'distance_miles')
-        
-        # Add closest outside resources
-        for _, row in closest_outside.iterrows():
-            name = row.get('organization_name', 'N/A')
-            address = row.get('address', 'N/A')
-            phone = row.get('phone_number', 'N/A')
-            distance_miles = row['distance_miles']
-            response += f"{name}\n{address}\n{phone}\nEstimated distance: {distance_miles:.1f} miles away\n---\n"
-    
+    # Resources inside the zipcode, then the closest outside it
+    ranked = [(category_index.snippets[position], inside, distance_miles)
+              for position, inside, distance_miles in rank_resources(category_index, zip_polygon, zip_centroid)]
+    return render_resources(resource_category, zipcode, ranked)
+
+# Builds the resource reply from (snippet, inside, distance_miles) tuples, with the
+# resources inside the zipcode first. The snippets are preformatted, so this is a single join.
+def render_resources(resource_category, zipcode, ranked):
+    inside_zipcode = resource_inside_zipcode.format(zipcode=zipcode)
+    response = f"Here are the closest {resource_category} resources to {zipcode}:\n\n---\n" + "".join(
+        snippet + (inside_zipcode if inside else resource_distance.format(distance_miles=distance_miles))
+        for snippet, inside, distance_miles in ranked)
     return response.strip()
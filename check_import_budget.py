@@ -0,0 +1,75 @@
+# check_import_budget.py
+
+"""
+Measures how long a gunicorn worker spends importing the SMS webhook code, and fails if it is
+over budget or if the geo stack gets imported at boot.
+
+Usage:
+    python check_import_budget.py [--budget-ms 1500] [--module chatbot]
+
+The import is timed in a fresh interpreter with `python -X importtime`, so nothing already
+imported by this script skews the numbers. The slowest imports are printed to help find regressions.
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+# Default import-time budget for the webhook modules, in milliseconds
+DEFAULT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "1500"))
+
+# Modules that must not be imported when a worker boots. They are only needed to build
+# the resource answer table, or for the geographic fallback on the first resource lookup.
+# rapidfuzz before 3.7 imports pandas (for pandas.NA) when it's imported, hence the pinned 3.7+.
+FORBIDDEN_AT_BOOT = ["pandas", "geopandas", "shapely", "pyproj", "pyogrio"]
+
+
+# Runs `python -X importtime -c "import <module>"` and returns a list of
+# (cumulative_us, self_us, depth, module) tuples, one per imported module
+def measure_imports(module):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        sys.exit(f"Importing {module} failed:\n{result.stderr}")
+    imports = []
+    for line in result.stderr.splitlines():
+        # Lines look like: "import time:       123 |       4567 |   package.module"
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((int(cumulative_us), int(self_us), depth, name.strip()))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the worker import-time budget.")
+    parser.add_argument("--module", default="chatbot", help="module a worker imports to serve /sms (default: chatbot)")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="import-time budget in milliseconds")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to print")
+    args = parser.parse_args()
+
+    imports = measure_imports(args.module)
+    total_ms = next(cumulative for cumulative, _, _, name in imports if name == args.module) / 1000
+    print(f"import {args.module}: {total_ms:.0f} ms (budget {args.budget_ms:.0f} ms)\n")
+    print("Slowest top-level imports:")
+    top_level = sorted((i for i in imports if i[2] <= 1), reverse=True)[:args.top]
+    for cumulative_us, _, _, name in top_level:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+    failures = []
+    imported = {name.split(".")[0] for _, _, _, name in imports}
+    for module in FORBIDDEN_AT_BOOT:
+        if module in imported:
+            failures.append(f"{module} is imported at boot")
+    if total_ms > args.budget_ms:
+        failures.append(f"import {args.module} took {total_ms:.0f} ms, over the {args.budget_ms:.0f} ms budget")
+    if failures:
+        print("\nFAILED:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+    print("\nOK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# conversation.py
+
+"""
+This file contains the conversation engine that runs the SMS conversation flow.
+The flow itself is declared as data in state_handlers.py: each State has an intent matcher and a
+table of Transitions keyed by intent, and each Transition says what to record, which events to log,
+which state comes next and what to reply.
+
+Every message goes through the same code path, whatever the state: match the reply to an intent,
+look up its transition (two dict lookups), apply it, and render the reply.
+
+Replies that never change (the menus, questions, helpline info and invalid-response messages) are
+serialized to TwiML bytes once at startup, when the state table is built, and sent as they are.
+Only dynamic replies, such as resource lookups and the latest alert, are built with MessagingResponse.
+"""
+
+from twilio.twiml.messaging_response import MessagingResponse
+from database import db, SMSUser
+from event_handlers import create_event, event_sms_sent
+from metrics import phase_seconds
+
+
+# Renders the TwiML bytes for a single reply message, with an optional image
+def render_twiml(text, media=None):
+    resp = MessagingResponse()
+    msg = resp.message(text)
+    if media is not None:
+        msg.media(media)
+    return str(resp).encode("utf-8")
+
+
+class Reply:
+    """A reply that never changes, serialized to TwiML bytes when it's created."""
+    __slots__ = ("text", "media", "twiml")
+
+    def __init__(self, text, media=None):
+        self.text = text
+        self.media = media
+        self.twiml = render_twiml(text, media)
+
+
+class LogEvent:
+    """
+    An analytics event logged by a transition. values are fixed columns (such as chatbot_service),
+    session_fields are copied from the user session when the event is logged (such as resource_category).
+    """
+    __slots__ = ("type", "session_fields", "values")
+
+    def __init__(self, type, session_fields=(), **values):
+        self.type = type
+        self.session_fields = session_fields
+        self.values = values
+
+    def log(self, ctx):
+        fields = {field: getattr(ctx.session, field) for field in self.session_fields}
+        create_event(ctx.hashed_phone_number, self.type, session_id=ctx.session.id, **self.values, **fields)
+
+
+class Transition:
+    """
+    What happens when a reply matches an intent, in this order:
+    - next_state: the state the conversation moves to (None to stay in the same state)
+    - action(ctx, intent): records the reply. It runs after the state changes, so it can change it again.
+    - events: the LogEvents logged, before the sms_sent event every reply logs
+    - reply: a Reply, or a function(ctx, intent) that returns the reply text (or one of several Replies)
+    """
+    __slots__ = ("reply", "next_state", "events", "action")
+
+    def __init__(self, reply, next_state=None, events=(), action=None):
+        self.reply = reply
+        self.next_state = next_state
+        self.events = events
+        self.action = action
+
+
+class State:
+    """
+    A conversation state.
+    - matcher: the IntentMatcher for replies in this state, or match: a function(body) returning the intent
+    - transitions: intent -> Transition
+    - on_match: the Transition for matched intents that aren't in transitions (such as every option of a
+      demographic question, which is recorded as is)
+    - default: the Transition when the reply matches nothing, usually an invalid response
+    """
+    __slots__ = ("name", "match", "transitions", "on_match", "default")
+
+    def __init__(self, name, default, matcher=None, match=None, transitions=None, on_match=None):
+        self.name = name
+        self.default = default
+        if match is None:
+            match = matcher.match if matcher is not None else _no_intent
+        self.match = match
+        self.transitions = transitions or {}
+        self.on_match = on_match
+
+    def transition(self, intent):
+        transition = self.transitions.get(intent)
+        if transition is not None:
+            return transition
+        if intent is not None and self.on_match is not None:
+            return self.on_match
+        return self.default
+
+
+def _no_intent(body):
+    return None
+
+
+class Context:
+    """
+    The message being handled, passed to actions and reply functions.
+    The user's row is only loaded from the database if an action asks for ctx.user.
+    """
+    __slots__ = ("session", "hashed_phone_number", "phone_number", "body", "_user")
+
+    def __init__(self, session, hashed_phone_number, phone_number, body):
+        self.session = session
+        self.hashed_phone_number = hashed_phone_number
+        self.phone_number = phone_number
+        self.body = body
+        self._user = None
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = db.session.get(SMSUser, self.hashed_phone_number)
+        return self._user
+
+
+# Reply for a session in a state with no handler. This shouldn't happen, but it's good to have a fallback.
+unknown_state_reply = Reply("An error occurred. Please try again later.")
+
+
+class Conversation:
+    """Runs the conversation flow declared by a list of States."""
+    def __init__(self, states):
+        self.states = {state.name: state for state in states}
+
+    def handle(self, user_session, hashed_phone_number, phone_number, body):
+        """Handles one message in the user's current state, and returns the TwiML reply as bytes."""
+        state = self.states.get(user_session.state)
+        if state is None:
+            return unknown_state_reply.twiml
+        ctx = Context(user_session, hashed_phone_number, phone_number, body)
+        intent = state.match(body)
+        transition = state.transition(intent)
+        if transition.next_state is not None:
+            user_session.state = transition.next_state
+        if transition.action is not None:
+            transition.action(ctx, intent)
+        for event in transition.events:
+            event.log(ctx)
+        event_sms_sent(hashed_phone_number, user_session.id)
+        reply = transition.reply
+        if not isinstance(reply, Reply):
+            reply = reply(ctx, intent)
+            if not isinstance(reply, Reply):
+                with phase_seconds.time("twiml"):
+                    return render_twiml(reply)
+        return reply.twiml
@@ -1,9 +1,22 @@
 from flask_sqlalchemy import SQLAlchemy
+from contextlib import contextmanager
 from datetime import datetime
 
 # Initialize the SQLAlchemy extension
 db = SQLAlchemy()
 
+# Unit of work for a single request. Everything the request adds or changes (users, sessions, events)
+# is committed together in one transaction when the block exits, or rolled back if it raises.
+# Code inside the block should flush() when it needs generated ids, and never commit() itself.
+@contextmanager
+def unit_of_work():
+    try:
+        yield db.session
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
 # Define the database model for the SMS users
 class SMSUser(db.Model):
     __tablename__ = 'users'
@@ -40,6 +53,9 @@ class SMSUserSession(db.Model):
     # Each SMSUserSession can have multiple associated Events, and each Event belongs to one SMSUserSession,
     # as defined by a foreign key in the Event table.
     events = db.relationship('Event', backref='session')
+    # Every inbound SMS looks up the latest session for a phone number, which this index serves.
+    # Indexes are added to existing databases by the Alembic migrations in migrations/versions.
+    __table_args__ = (db.Index('ix_sessions_hashed_phone_number_last_interaction', 'hashed_phone_number', 'last_interaction'),)
 
 # Define the database model for the events
 class Event(db.Model):
@@ -48,19 +64,19 @@ class Event(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     # session_id is a 'foreign key' linking an event to the corresponding SMSUserSession.
     # This means that every Event must have a corresponding session_id
-    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'))
+    session_id = db.Column(db.Integer, db.ForeignKey('sessions.id'), index=True)
     # hashed_phone_number is a 'foreign key' linking an event to the corresponding SMSUser.
     # This means that every Event must have a corresponding hashed_phone_number
-    hashed_phone_number = db.Column(db.String, db.ForeignKey('users.hashed_phone_number')) 
+    hashed_phone_number = db.Column(db.String, db.ForeignKey('users.hashed_phone_number'), index=True)
     # type is used to track the type of event, such as 'opt_in', 'opt_out', 'resource_view'
-    type = db.Column(db.String)
+    type = db.Column(db.String, index=True)
     # chatbot_service is used to track the chatbot service that the user is using, such as 'resource_menu or 'hotline_menu'
     chatbot_service = db.Column(db.String)
     # resource_category is used to track the resource category that the user is viewing, such as 'Syringe Service Program'
     resource_category = db.Column(db.String)
     # hotline_program is used to track the hotline program that the user is using, such as 'SafeSpot'
     helpline_program = db.Column(db.String)
-    timestamp = db.Column(db.DateTime, default=datetime.now())
+    timestamp = db.Column(db.DateTime, default=datetime.now(), index=True)
     page_number = db.Column(db.Integer)
 
 # Define the database model for the emergency alert users
@@ -68,7 +84,8 @@ class EmergencyAlertUsers(db.Model):
     __tablename__ = 'alert_users'
     # Define the columns for the EmergencyAlertUsers model
     id = db.Column(db.Integer, primary_key=True)
-    phone_number = db.Column(db.String)
+    # Looked up by phone number when a user opens the alerts menu or unsubscribes
+    phone_number = db.Column(db.String, index=True)
     total_alerts = db.Column(db.Integer)
     timestamp_user_created = db.Column(db.DateTime, default=datetime.now())
 
@@ -78,8 +95,42 @@ class EmergencyAlerts(db.Model):
     # Define the columns for the EmergencyAlerts model
     id = db.Column(db.Integer, primary_key=True)
     message = db.Column(db.String)
-    timestamp = db.Column(db.DateTime, default=datetime.now())
+    # The latest alert is looked up by timestamp
+    timestamp = db.Column(db.DateTime, default=datetime.now(), index=True)
     number_of_users_sent = db.Column(db.Integer)
+    # The text actually sent by SMS. message is the sanitized copy, for display.
+    sms_body = db.Column(db.String)
+    # status is 'sending' while the broadcast job is running, then 'complete'.
+    # Alerts recorded before broadcast jobs existed are 'complete'.
+    status = db.Column(db.String, default='complete', server_default='complete')
+    total_recipients = db.Column(db.Integer)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # Refreshed while the broadcast job runs. A 'sending' alert whose heartbeat stops is resumed by another worker.
+    heartbeat_at = db.Column(db.DateTime)
+    # 'deliveries' defines a one-to-many relationship with the AlertDelivery model (the delivery ledger)
+    deliveries = db.relationship('AlertDelivery', backref='alert')
+
+# Define the database model for the emergency alert delivery ledger
+class AlertDelivery(db.Model):
+    __tablename__ = 'alert_deliveries'
+    # Define the columns for the AlertDelivery model
+    id = db.Column(db.Integer, primary_key=True)
+    # alert_id is a 'foreign key' linking a delivery to the corresponding EmergencyAlerts row
+    alert_id = db.Column(db.Integer, db.ForeignKey('emergency_alerts.id'), nullable=False)
+    # alert_user_id is the EmergencyAlertUsers row the alert goes to. It isn't a foreign key,
+    # because subscribers who unsubscribe are deleted while their deliveries are kept.
+    alert_user_id = db.Column(db.Integer, nullable=False)
+    # status is one of 'pending', 'sending', 'sent', 'failed', 'skipped' (unsubscribed before it was sent)
+    # or 'unknown' (the worker died while it was being sent, so it isn't sent again)
+    status = db.Column(db.String, nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    twilio_sid = db.Column(db.String)
+    error = db.Column(db.String)
+    updated_at = db.Column(db.DateTime)
+    # Each subscriber gets each alert at most once, and jobs look up deliveries by alert and status
+    __table_args__ = (db.UniqueConstraint('alert_id', 'alert_user_id', name='uq_alert_deliveries_alert_id_alert_user_id'),
+                      db.Index('ix_alert_deliveries_alert_id_status', 'alert_id', 'status'))
 
 """The foreign keys confer a degree of integrity to the database. Although the code would 
 work without them, the foreign keys ensure that the data is consistent across the tables.
@@ -0,0 +1,143 @@
+# db_pool.py
+
+"""
+This file contains the database engine profile and its instrumentation.
+The engine options (pool size, overflow, pre-ping, recycling, statement timeout) come from the
+environment and are passed to Flask-SQLAlchemy through app.config['SQLALCHEMY_ENGINE_OPTIONS'].
+
+With DB_PGBOUNCER=1 the app connects through PgBouncer (transaction pooling): SQLAlchemy keeps no pool
+of its own (NullPool), and the statement timeout is set per transaction with SET LOCAL, because
+PgBouncer doesn't pass startup options on to Postgres.
+
+PoolMonitor counts connections, checkouts, the time spent waiting for a pooled connection, and the
+number of queries each request runs. The admin health endpoint reports them.
+"""
+
+import os
+import time
+import threading
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool, QueuePool
+from database import db
+
+# Connections kept open per worker process, and extra connections allowed under bursts
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+# Seconds to wait for a connection when the pool is exhausted, before failing
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+# Connections older than this many seconds are replaced, before the server or a proxy drops them
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+# Test each connection with a cheap query when it's checked out, and replace it if it's gone stale
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "1") != "0"
+# Postgres statement_timeout in milliseconds (0 for none)
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "0"))
+# Set DB_PGBOUNCER=1 when DATABASE_URL points at PgBouncer in transaction pooling mode
+DB_PGBOUNCER = os.environ.get("DB_PGBOUNCER", "0") == "1"
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that records how long each checkout waited for a connection."""
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_monitor.record_wait(time.perf_counter() - start)
+
+
+def engine_options(database_uri):
+    """The engine options for app.config['SQLALCHEMY_ENGINE_OPTIONS']."""
+    if database_uri.startswith("sqlite"):
+        # SQLite (development) keeps SQLAlchemy's defaults
+        return {}
+    if DB_PGBOUNCER:
+        return {"poolclass": NullPool}
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if DB_STATEMENT_TIMEOUT_MS:
+        options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
+
+class PoolMonitor:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        # Endpoint -> requests, queries and the most queries a single request ran
+        self.endpoints = {}
+
+    def init_app(self, app):
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "before_cursor_execute", self._on_query)
+        if DB_PGBOUNCER and DB_STATEMENT_TIMEOUT_MS and engine.dialect.name == "postgresql":
+            event.listen(engine, "begin", _set_local_statement_timeout)
+        app.teardown_request(self._record_request)
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.waits += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self.lock:
+            self.checkouts += 1
+
+    # Queries run while handling a request are counted on flask.g. Background threads aren't counted.
+    def _on_query(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            g.db_queries = g.get("db_queries", 0) + 1
+
+    def _record_request(self, exc):
+        queries = g.get("db_queries", 0)
+        endpoint = request.endpoint or "unknown"
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {"requests": 0, "queries": 0, "max_queries": 0})
+            stats["requests"] += 1
+            stats["queries"] += queries
+            stats["max_queries"] = max(stats["max_queries"], queries)
+
+    def stats(self):
+        pool = db.engine.pool
+        pool_stats = {"class": type(pool).__name__}
+        if isinstance(pool, QueuePool):
+            pool_stats.update(size=pool.size(), checked_out=pool.checkedout(), checked_in=pool.checkedin(),
+                              overflow=pool.overflow())
+        with self.lock:
+            endpoints = {endpoint: dict(stats, average_queries=round(stats["queries"] / stats["requests"], 2))
+                         for endpoint, stats in self.endpoints.items()}
+            return {
+                "pool": pool_stats,
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "average_wait_ms": round(self.wait_seconds / self.waits * 1000, 3) if self.waits else 0.0,
+                "max_wait_ms": round(self.max_wait_seconds * 1000, 3),
+                "queries_per_request": endpoints,
+            }
+
+
+# PgBouncer mode: the timeout only lasts for the transaction, so it can't leak to another client's connection
+def _set_local_statement_timeout(conn):
+    conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(DB_STATEMENT_TIMEOUT_MS)}")
+
+
+pool_monitor = PoolMonitor()
@@ -0,0 +1,169 @@
+# deferred_replies.py
+
+"""
+This file contains the deferred-reply mode of the /sms webhook.
+Twilio gives up on a webhook after 15 seconds, and the user gets no reply at all. A slow resource
+lookup or a busy database can occasionally take that long.
+
+With SMS_DEFERRED_REPLIES=1 the webhook only queues the message and returns an empty TwiML response
+right away. Worker threads then handle the message exactly like the webhook would (process_message in
+chatbot.py), and send the reply through the Twilio Messages API instead of in the webhook response.
+
+Messages are sharded across the workers by phone number, and each worker handles its queue in order,
+finishing one message (reply sent) before starting the next. So a user's messages are handled, and
+their replies sent, in the order they arrived. The ordering holds within one process, so when it
+matters run this mode with a single gunicorn worker process (and more threads). With several processes,
+SMS_SERIALIZE_USERS still keeps a user's messages from being handled at the same time.
+"""
+
+import os
+import sys
+import time
+import queue
+import random
+import atexit
+import zlib
+import threading
+import xml.etree.ElementTree as ElementTree
+import requests
+from twilio.twiml.messaging_response import MessagingResponse
+from alert_broadcast import TWILIO_API_BASE, RETRYABLE_STATUSES
+
+# Set SMS_DEFERRED_REPLIES=1 to acknowledge Twilio immediately and send replies through the Messages API
+SMS_DEFERRED_REPLIES = os.environ.get("SMS_DEFERRED_REPLIES", "0") == "1"
+# Number of worker threads (and queues) messages are sharded across
+DEFERRED_REPLY_WORKERS = int(os.environ.get("DEFERRED_REPLY_WORKERS", "4"))
+# How many times sending a reply is retried after a transient Twilio error
+DEFERRED_REPLY_MAX_RETRIES = int(os.environ.get("DEFERRED_REPLY_MAX_RETRIES", "2"))
+# Seconds to wait before the first retry, when Twilio doesn't say (Retry-After). Doubles with each retry.
+DEFERRED_REPLY_RETRY_BACKOFF = float(os.environ.get("DEFERRED_REPLY_RETRY_BACKOFF", "1"))
+# How long (in seconds) a shutting down worker process waits for queued messages to be handled
+DEFERRED_REPLY_DRAIN_SECONDS = float(os.environ.get("DEFERRED_REPLY_DRAIN_SECONDS", "10"))
+
+# The webhook response in deferred mode: no message, the reply is sent separately
+empty_twiml = str(MessagingResponse()).encode("utf-8")
+
+
+# Turns the TwiML returned by process_message into the messages to send: (body, media urls) pairs
+def twiml_messages(twiml):
+    messages = []
+    for message in ElementTree.fromstring(twiml).iter("Message"):
+        body_element = message.find("Body")
+        body = body_element.text if body_element is not None else message.text
+        media = [media.text for media in message.iter("Media")]
+        messages.append((body or "", media))
+    return messages
+
+
+# How long to wait before retrying a reply: the Retry-After Twilio sent with a 429 (in seconds),
+# otherwise exponential backoff with jitter, so the workers' retries don't all land at once
+def retry_delay(attempt, retry_after=None):
+    if retry_after is not None and retry_after.strip().isdigit():
+        return float(retry_after)
+    return DEFERRED_REPLY_RETRY_BACKOFF * (2 ** attempt) * (0.5 + random.random())
+
+
+class DeferredReplies:
+    def __init__(self, workers=DEFERRED_REPLY_WORKERS):
+        self.workers = workers
+        self.app = None
+        self.queues = []
+        self.threads = []
+        self.threads_pid = None
+        self.lock = threading.Lock()
+        self.registered_atexit = False
+        self.http = None
+        # Counters for monitoring
+        self.handled = 0
+        self.failed = 0
+
+    def init_app(self, app):
+        self.app = app
+
+    def enqueue(self, phone_number, body):
+        """Queue an inbound message. Messages from the same phone number always go to the same worker."""
+        self._ensure_threads()
+        shard = zlib.crc32((phone_number or "").encode()) % self.workers
+        self.queues[shard].put((phone_number, body))
+
+    # The threads are started lazily, so each gunicorn worker starts its own after forking
+    def _ensure_threads(self):
+        if self.threads_pid == os.getpid():
+            return
+        with self.lock:
+            if self.threads_pid == os.getpid():
+                return
+            self.http = requests.Session()
+            self.queues = [queue.Queue() for _ in range(self.workers)]
+            self.threads = [threading.Thread(target=self._run, args=(q,), name=f"deferred-replies-{i}", daemon=True)
+                            for i, q in enumerate(self.queues)]
+            for thread in self.threads:
+                thread.start()
+            self.threads_pid = os.getpid()
+        if not self.registered_atexit:
+            # Handle the messages still queued when the worker shuts down
+            atexit.register(self.drain)
+            self.registered_atexit = True
+
+    def _run(self, messages):
+        while True:
+            phone_number, body = messages.get()
+            try:
+                self._handle(phone_number, body)
+                self.handled += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Error handling a deferred SMS reply: {e}", file=sys.stderr)
+            finally:
+                messages.task_done()
+
+    def _handle(self, phone_number, body):
+        # Imported here because chatbot.py imports this module
+        from chatbot import process_message
+        with self.app.app_context():
+            twiml = process_message(phone_number, body)
+        for text, media in twiml_messages(twiml):
+            self._send(phone_number, text, media)
+
+    # Sends one reply through the Twilio Messages API, retrying transient errors.
+    # The worker waits out the retries before it sends anything else, so the user's replies stay in order.
+    def _send(self, to, body, media):
+        account_sid = os.getenv('TWILIO_ACCOUNT_SID')
+        url = f"{TWILIO_API_BASE}/2010-04-01/Accounts/{account_sid}/Messages.json"
+        data = {"To": to, "From": os.getenv('TWILIO_FROM'), "Body": body}
+        if media:
+            data["MediaUrl"] = media
+        for attempt in range(DEFERRED_REPLY_MAX_RETRIES + 1):
+            retry_after = None
+            try:
+                response = self.http.post(url, data=data, auth=(account_sid or "", os.getenv('TWILIO_AUTH_TOKEN') or ""), timeout=10)
+            except requests.RequestException as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if response.status_code in (200, 201):
+                    return
+                error = f"HTTP {response.status_code}: {response.text}"
+                if response.status_code not in RETRYABLE_STATUSES:
+                    break
+                retry_after = response.headers.get("Retry-After")
+            if attempt < DEFERRED_REPLY_MAX_RETRIES:
+                time.sleep(retry_delay(attempt, retry_after))
+        raise RuntimeError(f"Couldn't send the SMS reply: {error}")
+
+    def drain(self, timeout=DEFERRED_REPLY_DRAIN_SECONDS):
+        """Wait (up to timeout seconds) for the queued messages to be handled."""
+        if self.threads_pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if all(q.unfinished_tasks == 0 for q in self.queues):
+                return
+            time.sleep(0.05)
+        print(f"{self.stats()['queued']} deferred SMS replies were still queued at shutdown", file=sys.stderr)
+
+    def stats(self):
+        queued = sum(q.qsize() for q in self.queues) if self.threads_pid == os.getpid() else 0
+        return {"queued": queued, "handled": self.handled, "failed": self.failed}
+
+
+deferred_replies = DeferredReplies()
@@ -6,13 +6,22 @@ These events are logged in the database for analytics and reporting purposes.
 """
 
 # Import the database and event models from the database.py file
+from datetime import datetime
 from database import db, Event
+from event_writer import EVENT_BUFFER_ENABLED, stage_event
+from metrics import timed, phase_seconds
 
-# Create a new event in the database
+# Create a new event in the database.
+# By default the event is handed to the buffered event writer once the request's unit of work commits,
+# so analytics never add a database round-trip to the reply. The timestamp is taken now, not when it's written.
+@timed(phase_seconds, "event")
 def create_event(hashed_phone_number, type, resource_category=None, session_id=None, page_number=None, helpline_program=None, chatbot_service=None):
-    event = Event(hashed_phone_number=hashed_phone_number, type=type, resource_category=resource_category, session_id=session_id, page_number=page_number, helpline_program=helpline_program, chatbot_service=chatbot_service)
-    db.session.add(event)
-    db.session.commit()
+    row = dict(hashed_phone_number=hashed_phone_number, type=type, resource_category=resource_category, session_id=session_id, page_number=page_number,
+               helpline_program=helpline_program, chatbot_service=chatbot_service, timestamp=datetime.now())
+    if EVENT_BUFFER_ENABLED:
+        stage_event(row)
+    else:
+        db.session.add(Event(**row))
 
 # This event is triggered when an SMS is received by the chatbot
 def event_sms_received(hashed_phone_number, session_id=None):
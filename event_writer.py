@@ -0,0 +1,182 @@
+# event_writer.py
+
+"""
+This file contains the buffered writer for analytics events.
+Instead of inserting each Event on the reply path, events are queued in memory and written
+in bulk (one multi-row INSERT per batch) by a background thread, either when enough events
+have queued up or after a short interval.
+
+Events created during a request are held on the database session and only handed to the
+writer once the request's unit of work commits, so they never reference a user or session
+row that was rolled back. If the database is unavailable or slow, batches are appended to a
+local spill file and replayed on the next successful flush.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from datetime import datetime
+from sqlalchemy import event, insert
+from database import db, Event
+
+# Set EVENT_BUFFER_ENABLED=0 to write events in the request's transaction instead
+EVENT_BUFFER_ENABLED = os.environ.get("EVENT_BUFFER_ENABLED", "1") != "0"
+# A batch is flushed once it reaches this many events...
+EVENT_BATCH_SIZE = int(os.environ.get("EVENT_BATCH_SIZE", "200"))
+# ...or after this many seconds, whichever comes first
+EVENT_FLUSH_INTERVAL = float(os.environ.get("EVENT_FLUSH_INTERVAL", "2"))
+# If more than this many events are waiting (the database is down or slow), new ones go straight to the spill file
+EVENT_MAX_BUFFER = int(os.environ.get("EVENT_MAX_BUFFER", "10000"))
+# Events that couldn't be written to the database, one JSON object per line
+EVENT_SPILL_PATH = os.environ.get("EVENT_SPILL_PATH", "event_spill.jsonl")
+
+
+class EventWriter:
+    def __init__(self, batch_size=EVENT_BATCH_SIZE, flush_interval=EVENT_FLUSH_INTERVAL,
+                 max_buffer=EVENT_MAX_BUFFER, spill_path=EVENT_SPILL_PATH):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.spill_path = spill_path
+        self.app = None
+        self.buffer = []
+        self.condition = threading.Condition()
+        # Only one flush writes to the database (and the spill file) at a time
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+        self.registered_atexit = False
+        # Counters for monitoring
+        self.written = 0
+        self.spilled = 0
+        self.failed_flushes = 0
+
+    def init_app(self, app):
+        self.app = app
+
+    def enqueue(self, rows):
+        """Queue event rows (dicts of Event columns) to be written in the background."""
+        if not rows:
+            return
+        self._ensure_thread()
+        with self.condition:
+            if len(self.buffer) >= self.max_buffer:
+                overflow = True
+            else:
+                overflow = False
+                self.buffer.extend(rows)
+                if len(self.buffer) >= self.batch_size:
+                    self.condition.notify()
+        if overflow:
+            self._spill(rows)
+
+    def flush(self):
+        """Write everything queued, plus anything in the spill file, to the database."""
+        with self.condition:
+            rows, self.buffer = self.buffer, []
+        with self.flush_lock:
+            if rows:
+                try:
+                    self._insert(rows)
+                    self.written += len(rows)
+                except Exception as e:
+                    self.failed_flushes += 1
+                    print(f"Error writing {len(rows)} events, spilling them to {self.spill_path}: {e}", file=sys.stderr)
+                    self._spill(rows)
+                    return
+            self._replay_spill()
+
+    # One multi-row INSERT for the whole batch, outside of any request's session
+    def _insert(self, rows):
+        with self.app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(insert(Event.__table__), rows)
+
+    def _spill(self, rows):
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, default=datetime.isoformat) + "\n")
+        self.spilled += len(rows)
+
+    # Moves the spill file aside and writes its events to the database.
+    # If that fails, the events are spilled again and retried on the next flush.
+    def _replay_spill(self):
+        if not os.path.exists(self.spill_path):
+            return
+        replay_path = f"{self.spill_path}.{os.getpid()}.replay"
+        try:
+            os.replace(self.spill_path, replay_path)
+        except OSError:
+            return
+        with open(replay_path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        for row in rows:
+            if row.get("timestamp"):
+                row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+        written = 0
+        try:
+            while written < len(rows):
+                batch = rows[written:written + self.batch_size]
+                self._insert(batch)
+                written += len(batch)
+                self.written += len(batch)
+        except Exception as e:
+            self.failed_flushes += 1
+            print(f"Error replaying spilled events: {e}", file=sys.stderr)
+            # Only the rows that weren't written go back to the spill file
+            self._spill(rows[written:])
+        finally:
+            os.remove(replay_path)
+
+    # The thread is started lazily, so each gunicorn worker starts its own after forking
+    def _ensure_thread(self):
+        if self.thread is not None and self.thread_pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.condition:
+            if self.thread is not None and self.thread_pid == os.getpid() and self.thread.is_alive():
+                return
+            self.thread_pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name="event-writer", daemon=True)
+            self.thread.start()
+        if not self.registered_atexit:
+            # Write out whatever is queued when the worker shuts down
+            atexit.register(self.flush)
+            self.registered_atexit = True
+
+    def _run(self):
+        while True:
+            with self.condition:
+                deadline = time.monotonic() + self.flush_interval
+                while len(self.buffer) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error in the event writer: {e}", file=sys.stderr)
+
+    def stats(self):
+        with self.condition:
+            queued = len(self.buffer)
+        return {"queued": queued, "written": self.written, "spilled": self.spilled, "failed_flushes": self.failed_flushes}
+
+
+event_writer = EventWriter()
+
+
+# Events created during a request wait on the session until its transaction commits
+def stage_event(row):
+    db.session.info.setdefault("pending_events", []).append(row)
+
+@event.listens_for(db.session, "after_commit")
+def _release_pending_events(session):
+    event_writer.enqueue(session.info.pop("pending_events", None))
+
+@event.listens_for(db.session, "after_soft_rollback")
+def _discard_pending_events(session, previous_transaction):
+    session.info.pop("pending_events", None)
@@ -0,0 +1,63 @@
+# fake_twilio.py
+
+"""
+A local stand-in for the Twilio Messages API, for testing alert broadcasts without sending real texts.
+
+Usage:
+    python fake_twilio.py [--port 8999] [--latency-ms 50] [--fail-rate 0.05] [--rate-limit-rate 0.02] [--retry-after 1]
+
+Then run the app with TWILIO_API_BASE=http://localhost:8999. Every message it accepts is kept in
+memory and listed at GET /messages. A fraction of requests can be failed with a 500 or 429,
+to exercise the retries. 429s carry a Retry-After header of --retry-after seconds.
+"""
+
+import uuid
+import random
+import asyncio
+import argparse
+from aiohttp import web
+
+
+def make_app(latency_ms=50, fail_rate=0.0, rate_limit_rate=0.0, retry_after=1):
+    messages = []
+
+    # Same path and form fields as POST /2010-04-01/Accounts/{AccountSid}/Messages.json
+    async def create_message(request):
+        await asyncio.sleep(latency_ms / 1000)
+        roll = random.random()
+        if roll < rate_limit_rate:
+            return web.json_response({"code": 20429, "message": "Too Many Requests"}, status=429, headers={"Retry-After": str(retry_after)})
+        if roll < rate_limit_rate + fail_rate:
+            return web.json_response({"code": 20500, "message": "Internal Server Error"}, status=500)
+        form = await request.post()
+        if not form.get("To"):
+            return web.json_response({"code": 21604, "message": "A 'To' phone number is required."}, status=400)
+        message = {"sid": "SM" + uuid.uuid4().hex, "account_sid": request.match_info["account_sid"],
+                   "to": form.get("To"), "from": form.get("From"), "body": form.get("Body"),
+                   "media_url": form.getall("MediaUrl", []), "status": "queued"}
+        messages.append(message)
+        return web.json_response(message, status=201)
+
+    async def list_messages(request):
+        return web.json_response({"count": len(messages), "messages": messages})
+
+    async def clear_messages(request):
+        messages.clear()
+        return web.json_response({"count": 0})
+
+    app = web.Application()
+    app.router.add_post("/2010-04-01/Accounts/{account_sid}/Messages.json", create_message)
+    app.router.add_get("/messages", list_messages)
+    app.router.add_delete("/messages", clear_messages)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake Twilio Messages API.")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--latency-ms", type=float, default=50, help="delay before each response")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests answered with a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds of the 429 responses")
+    args = parser.parse_args()
+    web.run_app(make_app(args.latency_ms, args.fail_rate, args.rate_limit_rate, args.retry_after), port=args.port)
@@ -0,0 +1,175 @@
+# geo_index.py
+
+"""
+This file contains the geographic indexes used to look up resources by zipcode.
+The zipcode shapefile and the resource data are read and re-projected once per process instead
+of on every ZIPCODE_INPUT message, so each lookup becomes a dictionary hit plus tree queries.
+"""
+
+import os
+import threading
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely import STRtree
+from response_content import zipcode_not_found, resource_snippet
+
+# Constants
+LL_CRS = "EPSG:4326"      # lon/lat WGS-84
+MA_SPCS = "EPSG:26986"    # NAD83 / Massachusetts Mainland - metres
+
+# Location of the Massachusetts zipcode shapefile
+ZIPCODE_SHAPEFILE_PATH = "./zipcodes_shapefile"
+# Location of the resource data
+RESOURCES_CSV_PATH = "resources_data.csv"
+
+# Metres to miles, for the distances shown to the user
+METRES_TO_MILES = 0.000621371
+
+# Setting ZIP_INDEX_CENTROIDS=0 skips precomputing the centroids when the index is built.
+# They are then computed (and stored) the first time each zipcode is looked up.
+PRECOMPUTE_ZIP_CENTROIDS = os.environ.get("ZIP_INDEX_CENTROIDS", "1") != "0"
+
+
+class ZipIndex:
+    """
+    Projected zipcode polygons keyed by POSTCODE.
+    Polygons are stored in the MA_SPCS CRS so distances come out in metres.
+    """
+    def __init__(self, zip_path=ZIPCODE_SHAPEFILE_PATH, precompute_centroids=PRECOMPUTE_ZIP_CENTROIDS):
+        # Read the shapefile and project it once
+        zip_gdf = gpd.read_file(zip_path).to_crs(MA_SPCS)
+        # The original lookup used the first row matching a zipcode, so duplicates keep the first row
+        zip_gdf = zip_gdf.drop_duplicates(subset="POSTCODE", keep="first")
+        postcodes = zip_gdf["POSTCODE"].astype(str)
+        self.polygons = dict(zip(postcodes, zip_gdf.geometry))
+        self.centroids = {}
+        if precompute_centroids:
+            self.centroids = dict(zip(postcodes, zip_gdf.geometry.centroid))
+
+    def __contains__(self, zipcode):
+        return str(zipcode) in self.polygons
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def polygon(self, zipcode):
+        """Return the projected polygon for a zipcode. Raises ValueError if the zipcode is unknown."""
+        try:
+            return self.polygons[str(zipcode)]
+        except KeyError:
+            raise ValueError(zipcode_not_found.format(zipcode=zipcode))
+
+    def centroid(self, zipcode):
+        """Return the projected centroid for a zipcode, computing and storing it if it wasn't precomputed."""
+        zipcode = str(zipcode)
+        centroid = self.centroids.get(zipcode)
+        if centroid is None:
+            centroid = self.polygon(zipcode).centroid
+            self.centroids[zipcode] = centroid
+        return centroid
+
+    def contains(self, zipcode, point):
+        """Point-in-polygon test for a projected point."""
+        return self.polygon(zipcode).contains(point)
+
+
+class CategoryIndex:
+    """
+    The resources of a single category: their rows, their projected coordinates,
+    an STRtree over the points and the preformatted reply snippet of each resource.
+    """
+    def __init__(self, rows, points):
+        # Positions in rows, x, y, points and snippets all line up
+        self.rows = rows.reset_index(drop=True)
+        self.points = np.asarray(points)
+        self.x = np.asarray(points.x)
+        self.y = np.asarray(points.y)
+        self.tree = STRtree(self.points)
+        self.snippets = [resource_snippet.format(name=row.get('organization_name', 'N/A'), address=row.get('address', 'N/A'), phone=row.get('phone_number', 'N/A'))
+                         for _, row in self.rows.iterrows()]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def inside_mask(self, polygon):
+        """Boolean mask of the resources inside a projected polygon."""
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.tree.query(polygon, predicate="contains")] = True
+        return mask
+
+    def distances(self, point):
+        """Distance (in metres) from a projected point to every resource."""
+        return np.hypot(self.x - point.x, self.y - point.y)
+
+
+class ResourceIndex:
+    """
+    The resources in resources_data.csv, grouped by resource_category and projected
+    to the same CRS as the ZipIndex.
+    """
+    def __init__(self, csv_path=RESOURCES_CSV_PATH):
+        df = pd.read_csv(csv_path)
+        self.categories = {}
+        # Flag the dataset rather than raising, so the chatbot can tell the user what's wrong
+        self.missing_coordinates = 'longitude' not in df.columns or 'latitude' not in df.columns
+        if self.missing_coordinates:
+            return
+        # Project every resource once
+        points = gpd.GeoSeries(gpd.points_from_xy(df["longitude"], df["latitude"]), index=df.index, crs=LL_CRS).to_crs(MA_SPCS)
+        for resource_category, rows in df.groupby('resource_category', sort=False):
+            self.categories[resource_category] = CategoryIndex(rows, points.loc[rows.index])
+
+    def category(self, resource_category):
+        """Return the CategoryIndex for a category, or None if there are no resources in it."""
+        return self.categories.get(resource_category)
+
+
+# Ranks a category's resources for a zipcode, the way they are shown to the user:
+# every resource inside the zipcode (in dataset order), then the closest resources outside it
+# until there are `limit` in total. Returns (position, inside, distance_miles) tuples.
+def rank_resources(category_index, zip_polygon, zip_centroid, limit=5):
+    distances = category_index.distances(zip_centroid) * METRES_TO_MILES
+    inside_mask = category_index.inside_mask(zip_polygon)
+    inside_positions = np.flatnonzero(inside_mask)
+    ranked = [(int(i), True, float(distances[i])) for i in inside_positions]
+
+    # Resources inside the zipcode, or without coordinates, can't be picked as outside resources
+    outside_distances = np.where(inside_mask | np.isnan(distances), np.inf, distances)
+    remaining_count = min(limit - len(inside_positions), int(np.count_nonzero(np.isfinite(outside_distances))))
+    if remaining_count > 0:
+        # argpartition finds the k-th smallest distance without sorting everything.
+        # Everything up to it is then ordered by distance, ties in dataset order.
+        kth_distance = outside_distances[np.argpartition(outside_distances, remaining_count - 1)[remaining_count - 1]]
+        closest = np.flatnonzero(outside_distances <= kth_distance)
+        closest = closest[np.argsort(outside_distances[closest], kind="stable")][:remaining_count]
+        ranked += [(int(i), False, float(distances[i])) for i in closest]
+    return ranked
+
+
+# The indexes are built lazily on first use and shared by every request in the process
+_zip_index = None
+_resource_index = None
+_index_lock = threading.Lock()
+
+def get_zip_index():
+    global _zip_index
+    if _zip_index is None:
+        # The lock stops two threads from reading the shapefile at the same time
+        with _index_lock:
+            if _zip_index is None:
+                _zip_index = ZipIndex()
+    return _zip_index
+
+def get_resource_index():
+    global _resource_index
+    if _resource_index is None:
+        with _index_lock:
+            if _resource_index is None:
+                _resource_index = ResourceIndex()
+    return _resource_index
+
+# Builds the indexes at process start instead of on the first resource lookup
+def preload_geo_indexes():
+    get_zip_index()
+    get_resource_index()
@@ -0,0 +1,112 @@
+# intent_matcher.py
+
+"""
+This file contains the intent matcher used by the state handlers to understand user replies.
+Each state used to test a reply against its options one typos_check() at a time, lowercasing both
+strings again on every call, and the demographic states scanned their dictionary twice (once to
+check the reply was valid, once to find which option it was).
+
+Each state now has an IntentMatcher, compiled once at import with its options already lowercased.
+A reply is matched in two steps:
+1. An exact lookup of the reply (menu numbers like '1' and '0', '*', or an option typed exactly)
+2. Otherwise one rapidfuzz.process.extractOne call over every option of the state, which returns
+   the best option and its score in a single pass. Like typos_check(), an option only matches
+   if its fuzz.ratio score is above the ratio (85 by default).
+"""
+
+from rapidfuzz import fuzz, process
+from response_content import race_ethnicity_dictionary, multiracial_dictionary, gender_dictionary, age_group_dictionary
+
+
+class IntentMatcher:
+    """
+    Matches a reply to one of a state's intents. intents is a list of (intent, aliases) pairs, in
+    order of priority: when two intents share an alias, or tie on score, the first one wins, like
+    the first branch of an if/elif chain.
+    Numeric aliases (menu numbers) only match exactly, as they always have.
+    """
+    def __init__(self, intents, ratio=85):
+        self.ratio = ratio
+        # Lowercased alias -> intent, for the exact lookup
+        self.exact = {}
+        # Lowercased aliases for the fuzzy match, and the intent of each one
+        self.choices = []
+        self.choice_intents = []
+        for intent, aliases in intents:
+            for alias in aliases:
+                alias = alias.lower()
+                self.exact.setdefault(alias, intent)
+                if not alias.isdigit():
+                    self.choices.append(alias)
+                    self.choice_intents.append(intent)
+
+    # Builds a matcher for one of the numbered dictionaries in response_content.py, whose intents
+    # are the dictionary's values. Replies match either a key (the number) or a value.
+    @classmethod
+    def from_dictionary(cls, dictionary, extra_intents=(), ratio=85):
+        return cls(list(extra_intents) + [(value, (key, value)) for key, value in dictionary.items()], ratio)
+
+    def best(self, body):
+        """Returns the best matching intent and its score, or None and the best score if no intent matched."""
+        if body is None:
+            return None, 0
+        body = body.lower()
+        intent = self.exact.get(body)
+        if intent is not None:
+            return intent, 100
+        if not self.choices:
+            return None, 0
+        result = process.extractOne(body, self.choices, scorer=fuzz.ratio, score_cutoff=self.ratio)
+        # score_cutoff keeps scores equal to the ratio, typos_check() doesn't
+        if result is None or result[1] <= self.ratio:
+            return None, result[1] if result else 0
+        return self.choice_intents[result[2]], result[1]
+
+    def match(self, body):
+        """Returns the intent the reply matches, or None."""
+        return self.best(body)[0]
+
+
+# Intents shared by several states
+MENU = "menu"
+MENU_ALIASES = ('0', 'menu')
+# Choosing Multiracial branches to the multiracial questions. Replying '7' has always chosen this
+# branch (even though '7' is Middle Eastern/North African in the dictionary), while replying '8'
+# records Multiracial without the branch.
+MULTIRACIAL_BRANCH = "multiracial_branch"
+
+# The intent table of each state, compiled once at import
+REGISTRATION_INTENTS = IntentMatcher([("yes", ("yes",)), ("no", ("no",))])
+RACE_ETHNICITY_INTENTS = IntentMatcher.from_dictionary(race_ethnicity_dictionary,
+                                                       extra_intents=[(MULTIRACIAL_BRANCH, ("7", "multiracial"))])
+MULTIRACIAL_INTENTS = IntentMatcher.from_dictionary(multiracial_dictionary)
+GENDER_INTENTS = IntentMatcher.from_dictionary(gender_dictionary)
+AGE_GROUP_INTENTS = IntentMatcher.from_dictionary(age_group_dictionary)
+MAIN_MENU_INTENTS = IntentMatcher([
+    ("resource_menu", ("1", "harm reduction resources")),
+    ("helpline_menu", ("2", "talk with a helpline")),
+    ("emergency_alerts", ("3", "emergency alerts")),
+])
+# The intents of the resource menu are the resource categories
+RESOURCE_MENU_INTENTS = IntentMatcher([
+    ("Syringe Service Program", ("1", "syringe service program")),
+    ("Medication for Opioid Use Disorder", ("2", "medication for opioid use disorder")),
+    ("Naloxone & OD Education", ("3", "naloxone and overdose training")),
+    ("Bridge Clinic", ("4", "bridge clinic")),
+    ("Shelter", ("5", "shelter")),
+    ("Detox", ("6", "detox")),
+    (MENU, MENU_ALIASES),
+])
+RESOURCE_NAVIGATION_INTENTS = IntentMatcher([("resources", ("*", "resources")), (MENU, MENU_ALIASES)])
+# The intents of the helpline menu are the helpline programs. '4' has always meant SafeLink.
+HELPLINE_MENU_INTENTS = IntentMatcher([
+    ("MA Substance Use Helpline", ("1", "substance use help")),
+    ("SafeSpot", ("2", "safespot")),
+    ("Suicide and Crisis Lifeline", ("3", "suicide")),
+    ("SafeLink", ("4", "safe link")),
+    ("911", ("immediate danger",)),
+    (MENU, MENU_ALIASES),
+])
+HELPLINE_NAVIGATION_INTENTS = IntentMatcher([("helplines", ("*", "helplines")), (MENU, MENU_ALIASES)])
+NEW_ALERTS_USER_INTENTS = IntentMatcher([("add", ("add",)), (MENU, MENU_ALIASES)])
+EXISTING_ALERTS_USER_INTENTS = IntentMatcher([("remove", ("remove",)), ("latest", ("latest",)), (MENU, MENU_ALIASES)])
@@ -0,0 +1,175 @@
+# load_test.py
+
+"""
+A load generator for the /sms webhook. Synthetic users send Twilio-shaped form POSTs (From, Body)
+and walk realistic conversations: registration (sometimes through the multiracial questions), then
+the resource menu and zipcode lookups, the helplines, or the emergency alerts menu. Each user's
+messages are sent one after the other, like a real phone; many users run at once.
+
+Start the app against a local database first, for example:
+    DATABASE_URL=sqlite:///loadtest.db FIXED_SALT=loadtest SECRET_KEY=loadtest gunicorn -w 4 app:app -b :5000
+(or a local Postgres URL). Then:
+    python load_test.py --url http://localhost:5000/sms --users 2000 --concurrency 100
+
+It reports the latency (p50/p95/p99) and throughput of the messages sent in each conversation state,
+and overall. --json writes the same numbers to a file. Every synthetic number is new, so each run
+starts its users at registration.
+
+Latency is filed under the state the app says it handled the message in (the X-Conversation-State
+header of the reply), not the state the script expected. A conversation whose state differs from the
+script's has gone off-script: it's counted, and the user stops there, since the rest of the script
+no longer matches.
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+import aiohttp
+
+# Massachusetts zipcodes the synthetic users look up
+ZIPCODES = ["02139", "02115", "01002", "01608", "02740", "01103", "02301", "01201", "02601", "01840"]
+
+# Each step is (the state the user is in, the message they send)
+REGISTRATION = [("PRE-REGISTRATION", "hi"), ("REGISTRATION", "yes"), ("ASK_RACE_ETHNICITY", "4"),
+                ("ASK_GENDER", "1"), ("ASK_AGE_GROUP", "3")]
+MULTIRACIAL_REGISTRATION = [("PRE-REGISTRATION", "hello"), ("REGISTRATION", "Yes"), ("ASK_RACE_ETHNICITY", "multiracial"),
+                            ("ASK_MULTIRACIAL1", "1"), ("ASK_MULTIRACIAL2", "3"), ("ASK_GENDER", "3"), ("ASK_AGE_GROUP", "2")]
+
+def resources_path():
+    return [("MAIN_MENU", random.choice(["1", "harm reduction resources", "harm reducton resources"])),
+            ("RESOURCE_MENU", str(random.randint(1, 6))),
+            ("ZIPCODE_INPUT", random.choice(ZIPCODES)),
+            ("ZIPCODE_INPUT", random.choice(ZIPCODES)),
+            ("ZIPCODE_INPUT", "*"),
+            ("RESOURCE_MENU", "menu")]
+
+def helplines_path():
+    return [("MAIN_MENU", "2"),
+            ("HELPLINE_MENU", str(random.randint(1, 4))),
+            ("HELPLINE_VIEW", "*"),
+            ("HELPLINE_MENU", "0")]
+
+def alerts_path():
+    return [("MAIN_MENU", "3"),
+            ("NEW_ALERTS_USER", "add"),
+            ("MAIN_MENU", "3"),
+            ("EXISTING_ALERTS_USER", "latest"),
+            ("MAIN_MENU", "emergency alerts"),
+            ("EXISTING_ALERTS_USER", "remove")]
+
+# How often each kind of conversation happens
+PATHS = [(resources_path, 6), (helplines_path, 3), (alerts_path, 1)]
+
+
+def conversation():
+    registration = MULTIRACIAL_REGISTRATION if random.random() < 0.1 else REGISTRATION
+    path = random.choices([path for path, _ in PATHS], weights=[weight for _, weight in PATHS])[0]
+    return registration + path()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class Results:
+    def __init__(self):
+        # State -> latencies (seconds) of the messages sent in it, and the number of errors
+        self.latencies = {}
+        self.errors = {}
+        # Expected state -> number of conversations that weren't in it
+        self.off_script = {}
+
+    def record(self, state, seconds, ok):
+        self.latencies.setdefault(state, []).append(seconds)
+        if not ok:
+            self.errors[state] = self.errors.get(state, 0) + 1
+
+    def record_off_script(self, expected_state):
+        self.off_script[expected_state] = self.off_script.get(expected_state, 0) + 1
+
+    def summary(self, elapsed):
+        def stats(latencies, errors):
+            latencies = sorted(latencies)
+            return {
+                "requests": len(latencies),
+                "errors": errors,
+                "per_second": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+                "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+            }
+        states = {state: stats(latencies, self.errors.get(state, 0)) for state, latencies in sorted(self.latencies.items())}
+        everything = [seconds for latencies in self.latencies.values() for seconds in latencies]
+        return {"elapsed_seconds": round(elapsed, 2), "states": states,
+                "overall": stats(everything, sum(self.errors.values())),
+                "off_script": dict(sorted(self.off_script.items()))}
+
+
+async def run_user(session, url, phone_number, results, think_time):
+    for expected_state, body in conversation():
+        start = time.perf_counter()
+        state = None
+        try:
+            async with session.post(url, data={"From": phone_number, "Body": body}) as response:
+                text = await response.text()
+                ok = response.status == 200 and "<Response" in text
+                state = response.headers.get("X-Conversation-State")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+        results.record(state or expected_state, time.perf_counter() - start, ok)
+        if state and state != expected_state:
+            results.record_off_script(expected_state)
+            return
+        if think_time:
+            await asyncio.sleep(random.uniform(0, think_time))
+
+
+async def run(url, users, concurrency, think_time, timeout):
+    results = Results()
+    semaphore = asyncio.Semaphore(concurrency)
+    # A random prefix so each run uses new phone numbers
+    prefix = random.randint(100, 999)
+
+    async def user(i):
+        async with semaphore:
+            await run_user(session, url, f"+1555{prefix}{i:04d}", results, think_time)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(user(i) for i in range(users)))
+        elapsed = time.perf_counter() - start
+    return results.summary(elapsed)
+
+
+def print_summary(summary):
+    print(f"{'state':<22}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    rows = list(summary["states"].items()) + [("overall", summary["overall"])]
+    for state, stats in rows:
+        print(f"{state:<22}{stats['requests']:>9}{stats['errors']:>8}{stats['per_second']:>9}"
+              f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}")
+    print(f"\n{summary['overall']['requests']} messages in {summary['elapsed_seconds']}s")
+    if summary["off_script"]:
+        expected = ", ".join(f"{state}: {count}" for state, count in summary["off_script"].items())
+        print(f"{sum(summary['off_script'].values())} conversations went off-script (by the state the script expected: {expected})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay synthetic SMS conversations against the /sms webhook.")
+    parser.add_argument("--url", default="http://localhost:5000/sms")
+    parser.add_argument("--users", type=int, default=1000, help="number of synthetic phone numbers (at most 10000)")
+    parser.add_argument("--concurrency", type=int, default=50, help="users in a conversation at the same time")
+    parser.add_argument("--think-time", type=float, default=0.0, help="maximum random pause (seconds) between a user's messages")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds before a request counts as an error")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    summary = asyncio.run(run(args.url, min(args.users, 10000), args.concurrency, args.think_time, args.timeout))
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,207 @@
+# metrics.py
+
+"""
+This file contains the in-process metrics registry and the Prometheus text exposition of it.
+The admin /metrics endpoint (website.py) serves it.
+
+Recorded while handling messages:
+- chatbot_sms_message_seconds{state}: the whole message, labeled with the state it arrived in
+- chatbot_sms_state_seconds{state}: the conversation state's handler alone
+- chatbot_sms_phase_seconds{phase}: session lookup, resource lookup (and the computation on a cache
+  miss, which includes loading the geographic indexes the first time), events, and TwiML rendering
+- chatbot_db_query_seconds{statement}: every SQL statement, by kind (select, insert, ...)
+- chatbot_http_request_seconds{endpoint}, chatbot_http_request_queries{endpoint} and
+  chatbot_http_request_db_seconds{endpoint}: each web request, its query count and time spent in queries
+
+The stats() of the pool monitor, background writers and caches are added as gauges when /metrics is
+scraped, with hit ratios for the caches. The registry is per process: with several gunicorn workers,
+each scrape is answered by one of them. Set METRICS_ENABLED=0 to turn the recording off.
+"""
+
+import os
+import time
+import bisect
+import threading
+import functools
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+# Set METRICS_ENABLED=0 to stop recording metrics
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+
+# Histogram buckets (upper bounds), in seconds for latencies
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+METRIC_PREFIX = "chatbot_"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # Label values -> [count in each bucket (and above the last one), sum, count]
+        self.series = {}
+
+    def observe(self, value, *labelvalues):
+        if not METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labelvalues)
+            if series is None:
+                series = self.series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def exposition(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(labelvalues, list(counts), total, count) for labelvalues, (counts, total, count) in self.series.items()]
+        for labelvalues, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labelvalues, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, prefix=METRIC_PREFIX):
+        self.prefix = prefix
+        self.histograms = []
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        histogram = Histogram(self.prefix + name, help, labelnames, buckets)
+        self.histograms.append(histogram)
+        return histogram
+
+    def render(self, stats=None):
+        """
+        The Prometheus text exposition of every histogram, plus a gauge for each number in stats:
+        {"event_writer": {"queued": 3, ...}} becomes chatbot_event_writer_queued 3. Dicts one level
+        down are flattened the same way, and anything else is skipped. Groups with hits and misses
+        also get a hit ratio.
+        """
+        lines = []
+        for histogram in self.histograms:
+            lines.extend(histogram.exposition())
+        for group, values in (stats or {}).items():
+            for name, value in _numbers(values):
+                metric = f"{self.prefix}{group}_{name}"
+                lines.extend([f"# TYPE {metric} gauge", f"{metric} {_format_value(value)}"])
+            if isinstance(values.get("hits"), int) and isinstance(values.get("misses"), int):
+                lookups = values["hits"] + values["misses"]
+                metric = f"{self.prefix}{group}_hit_ratio"
+                lines.extend([f"# TYPE {metric} gauge", f"{metric} {_format_value(values['hits'] / lookups if lookups else 0.0)}"])
+        return "\n".join(lines) + "\n"
+
+
+# (name, number) pairs of a stats dict, with the dicts inside it flattened one level
+def _numbers(values, prefix=""):
+    for name, value in values.items():
+        if isinstance(value, bool):
+            yield prefix + name, int(value)
+        elif isinstance(value, (int, float)):
+            yield prefix + name, value
+        elif isinstance(value, dict) and not prefix:
+            yield from _numbers(value, prefix=f"{name}_")
+
+
+registry = MetricsRegistry()
+
+message_seconds = registry.histogram("sms_message_seconds", "Time to handle one inbound SMS, by the state it arrived in", ("state",))
+state_seconds = registry.histogram("sms_state_seconds", "Time spent in the conversation state's handler", ("state",))
+phase_seconds = registry.histogram("sms_phase_seconds", "Time spent in each phase of handling an SMS", ("phase",))
+query_seconds = registry.histogram("db_query_seconds", "Time to execute one SQL statement, by kind", ("statement",))
+request_seconds = registry.histogram("http_request_seconds", "Time to handle one web request", ("endpoint",))
+request_queries = registry.histogram("http_request_queries", "SQL statements run by one web request", ("endpoint",),
+                                     buckets=QUERY_COUNT_BUCKETS)
+request_db_seconds = registry.histogram("http_request_db_seconds", "Time one web request spent running SQL statements", ("endpoint",))
+
+
+def timed(histogram, *labelvalues):
+    """Decorator recording how long each call of the function takes in histogram."""
+    def decorate(function):
+        if not METRICS_ENABLED:
+            return function
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *labelvalues)
+        return wrapper
+    return decorate
+
+
+STATEMENT_KINDS = {"select", "insert", "update", "delete", "begin", "commit", "rollback"}
+
+class RequestMetrics:
+    """Times SQL statements and web requests. Query counts come from pool_monitor (db_pool.py)."""
+    def init_app(self, app):
+        if not METRICS_ENABLED:
+            return
+        from database import db
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", self._before_query)
+        event.listen(engine, "after_cursor_execute", self._after_query)
+        app.before_request(self._start_request)
+        app.teardown_request(self._record_request)
+
+    def _before_query(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def _after_query(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("query_start")
+        if not starts:
+            return
+        seconds = time.perf_counter() - starts.pop()
+        kind = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "other"
+        query_seconds.observe(seconds, kind if kind in STATEMENT_KINDS else "other")
+        if has_request_context():
+            g.db_seconds = g.get("db_seconds", 0.0) + seconds
+
+    def _start_request(self):
+        g.request_start = time.perf_counter()
+
+    def _record_request(self, exc):
+        start = g.get("request_start")
+        if start is None:
+            return
+        endpoint = request.endpoint or "unknown"
+        request_seconds.observe(time.perf_counter() - start, endpoint)
+        request_queries.observe(g.get("db_queries", 0), endpoint)
+        request_db_seconds.observe(g.get("db_seconds", 0.0), endpoint)
+
+
+request_metrics = RequestMetrics()
@@ -0,0 +1,37 @@
+# Alembic environment for the chatbot database.
+# The models' metadata comes from database.py, and the connection string from DATABASE_URL,
+# the same way app.py configures it (Heroku still hands out postgres:// URLs).
+import os
+from logging.config import fileConfig
+from alembic import context
+from sqlalchemy import create_engine, pool
+from database import db
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = db.metadata
+
+def database_url():
+    return os.environ.get('DATABASE_URL').replace('postgres://', 'postgresql://', 1)
+
+# Emit the SQL instead of running it (alembic upgrade head --sql)
+def run_migrations_offline():
+    context.configure(url=database_url(), target_metadata=target_metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+def run_migrations_online():
+    engine = create_engine(database_url(), poolclass=pool.NullPool)
+    with engine.connect() as connection:
+        # SQLite can't ALTER most things in place, so use batch mode there
+        context.configure(connection=connection, target_metadata=target_metadata,
+                          render_as_batch=connection.dialect.name == 'sqlite')
+        with context.begin_transaction():
+            context.run_migrations()
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,79 @@
+"""Baseline: the tables of the original schema
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+# The schema as db.create_all() first built it, before any migration. The release phase runs before
+# any web process has called db.create_all(), so a new database gets its tables here.
+# Tables that already exist (a database built by db.create_all()) are left as they are.
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('users'):
+        op.create_table(
+            'users',
+            sa.Column('hashed_phone_number', sa.String(), primary_key=True),
+            sa.Column('first_interaction', sa.DateTime()),
+            sa.Column('race_ethnicity', sa.String()),
+            sa.Column('multiracial1', sa.String()),
+            sa.Column('multiracial2', sa.String()),
+            sa.Column('gender', sa.String()),
+            sa.Column('age_group', sa.String()),
+            sa.Column('opt_in', sa.Boolean()),
+            sa.Column('opt_in_time', sa.DateTime()),
+        )
+    if not inspector.has_table('sessions'):
+        op.create_table(
+            'sessions',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('hashed_phone_number', sa.String(), sa.ForeignKey('users.hashed_phone_number')),
+            sa.Column('state', sa.String()),
+            sa.Column('last_interaction', sa.DateTime()),
+            sa.Column('first_interaction', sa.Boolean()),
+            sa.Column('resource_category', sa.String()),
+            sa.Column('page_number', sa.Integer()),
+            sa.Column('helpline_program', sa.String()),
+        )
+    if not inspector.has_table('events'):
+        op.create_table(
+            'events',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('session_id', sa.Integer(), sa.ForeignKey('sessions.id')),
+            sa.Column('hashed_phone_number', sa.String(), sa.ForeignKey('users.hashed_phone_number')),
+            sa.Column('type', sa.String()),
+            sa.Column('chatbot_service', sa.String()),
+            sa.Column('resource_category', sa.String()),
+            sa.Column('helpline_program', sa.String()),
+            sa.Column('timestamp', sa.DateTime()),
+            sa.Column('page_number', sa.Integer()),
+        )
+    if not inspector.has_table('alert_users'):
+        op.create_table(
+            'alert_users',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('phone_number', sa.String()),
+            sa.Column('total_alerts', sa.Integer()),
+            sa.Column('timestamp_user_created', sa.DateTime()),
+        )
+    if not inspector.has_table('emergency_alerts'):
+        op.create_table(
+            'emergency_alerts',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('message', sa.String()),
+            sa.Column('timestamp', sa.DateTime()),
+            sa.Column('number_of_users_sent', sa.Integer()),
+        )
+
+
+def downgrade():
+    for table in ('events', 'sessions', 'users', 'alert_users', 'emergency_alerts'):
+        op.drop_table(table)
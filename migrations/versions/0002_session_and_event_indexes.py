@@ -0,0 +1,39 @@
+"""Indexes for the per-message session lookup and the events table
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+# (index name, table, columns). Keep in sync with the index definitions in database.py.
+INDEXES = [
+    # Every inbound SMS looks up the latest session for a phone number
+    ('ix_sessions_hashed_phone_number_last_interaction', 'sessions', ['hashed_phone_number', 'last_interaction']),
+    ('ix_events_session_id', 'events', ['session_id']),
+    ('ix_events_hashed_phone_number', 'events', ['hashed_phone_number']),
+    ('ix_events_type', 'events', ['type']),
+    ('ix_events_timestamp', 'events', ['timestamp']),
+]
+
+
+# On Postgres the indexes are built CONCURRENTLY, so the events table isn't locked while they build.
+# That can't run in a transaction, hence the autocommit block.
+# if_not_exists covers databases whose tables (and indexes) were created by db.create_all().
+def upgrade():
+    concurrently = op.get_bind().dialect.name == 'postgresql'
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True, postgresql_concurrently=concurrently)
+
+
+def downgrade():
+    concurrently = op.get_bind().dialect.name == 'postgresql'
+    with op.get_context().autocommit_block():
+        for name, table, _ in INDEXES:
+            op.drop_index(name, table_name=table, if_exists=True, postgresql_concurrently=concurrently)
@@ -0,0 +1,56 @@
+"""Alert delivery ledger and broadcast job progress columns
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    # Databases created by db.create_all() after this change already have the new columns and table
+    existing_columns = {column['name'] for column in inspector.get_columns('emergency_alerts')}
+    with op.batch_alter_table('emergency_alerts') as batch_op:
+        if 'sms_body' not in existing_columns:
+            batch_op.add_column(sa.Column('sms_body', sa.String()))
+        if 'status' not in existing_columns:
+            # Alerts sent before the ledger existed are complete
+            batch_op.add_column(sa.Column('status', sa.String(), server_default='complete'))
+        if 'total_recipients' not in existing_columns:
+            batch_op.add_column(sa.Column('total_recipients', sa.Integer()))
+        if 'started_at' not in existing_columns:
+            batch_op.add_column(sa.Column('started_at', sa.DateTime()))
+        if 'finished_at' not in existing_columns:
+            batch_op.add_column(sa.Column('finished_at', sa.DateTime()))
+        if 'heartbeat_at' not in existing_columns:
+            batch_op.add_column(sa.Column('heartbeat_at', sa.DateTime()))
+
+    if not inspector.has_table('alert_deliveries'):
+        op.create_table(
+            'alert_deliveries',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('alert_id', sa.Integer(), sa.ForeignKey('emergency_alerts.id'), nullable=False),
+            sa.Column('alert_user_id', sa.Integer(), nullable=False),
+            sa.Column('status', sa.String(), nullable=False),
+            sa.Column('attempts', sa.Integer(), nullable=False),
+            sa.Column('twilio_sid', sa.String()),
+            sa.Column('error', sa.String()),
+            sa.Column('updated_at', sa.DateTime()),
+            sa.UniqueConstraint('alert_id', 'alert_user_id', name='uq_alert_deliveries_alert_id_alert_user_id'),
+        )
+        op.create_index('ix_alert_deliveries_alert_id_status', 'alert_deliveries', ['alert_id', 'status'])
+
+
+def downgrade():
+    op.drop_index('ix_alert_deliveries_alert_id_status', table_name='alert_deliveries')
+    op.drop_table('alert_deliveries')
+    with op.batch_alter_table('emergency_alerts') as batch_op:
+        for column in ('heartbeat_at', 'finished_at', 'started_at', 'total_recipients', 'status', 'sms_body'):
+            batch_op.drop_column(column)
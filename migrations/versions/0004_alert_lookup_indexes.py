@@ -0,0 +1,35 @@
+"""Indexes for the alert subscription and latest alert lookups
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+# (index name, table, columns). Keep in sync with the index definitions in database.py.
+INDEXES = [
+    # The alerts menu and unsubscribing look up the user's subscription by phone number
+    ('ix_alert_users_phone_number', 'alert_users', ['phone_number']),
+    # The latest alert is the one with the latest timestamp
+    ('ix_emergency_alerts_timestamp', 'emergency_alerts', ['timestamp']),
+]
+
+
+# Built CONCURRENTLY on Postgres, like 0002, so the tables aren't locked while the indexes build.
+def upgrade():
+    concurrently = op.get_bind().dialect.name == 'postgresql'
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, if_not_exists=True, postgresql_concurrently=concurrently)
+
+
+def downgrade():
+    concurrently = op.get_bind().dialect.name == 'postgresql'
+    with op.get_context().autocommit_block():
+        for name, table, _ in INDEXES:
+            op.drop_index(name, table_name=table, if_exists=True, postgresql_concurrently=concurrently)
@@ -0,0 +1,58 @@
+# phone_hashing.py
+
+"""
+This file contains the phone number hashing service.
+Phone numbers are never stored: every inbound message is identified by sha256(FIXED_SALT + phone number).
+The salt is read from the environment once, and hashed once into a sha256 state that each phone
+number's hash starts from (a copy of it), instead of hashing the salt again for every message.
+Recent phone number -> hash mappings are kept in a bounded LRU cache, in process memory only.
+"""
+
+import os
+import hashlib
+from functools import lru_cache
+
+# How many recent phone number -> hash mappings are kept
+PHONE_HASH_CACHE_SIZE = int(os.environ.get("PHONE_HASH_CACHE_SIZE", "4096"))
+
+
+class PhoneNumberHasher:
+    def __init__(self, salt=None, cache_size=PHONE_HASH_CACHE_SIZE):
+        self.salt = salt
+        self.cache_size = cache_size
+        self._prefix = None
+        self.hash = lru_cache(maxsize=cache_size)(self._hash)
+
+    # The sha256 state after the salt, built on first use so the environment is read once
+    def _salted(self):
+        if self._prefix is None:
+            salt = self.salt if self.salt is not None else os.environ.get("FIXED_SALT")
+            if salt is None:
+                raise RuntimeError("FIXED_SALT is not set, so phone numbers can't be hashed")
+            self._prefix = hashlib.sha256(salt.encode())
+        return self._prefix
+
+    def _hash(self, phone_number):
+        digest = self._salted().copy()
+        digest.update(phone_number.encode())
+        return digest.hexdigest()
+
+    def hash_many(self, phone_numbers):
+        """
+        Hashes many phone numbers at once, for backfills and migrations. Each distinct number is hashed
+        once, without going through (or filling) the LRU cache. Returns the hashes in the same order.
+        """
+        prefix = self._salted()
+        hashes = {}
+        for phone_number in phone_numbers:
+            if phone_number not in hashes:
+                digest = prefix.copy()
+                digest.update(phone_number.encode())
+                hashes[phone_number] = digest.hexdigest()
+        return [hashes[phone_number] for phone_number in phone_numbers]
+
+    def cache_info(self):
+        return self.hash.cache_info()
+
+
+phone_number_hasher = PhoneNumberHasher()
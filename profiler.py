@@ -0,0 +1,212 @@
+# profiler.py
+
+"""
+This file contains the sampling profiler for live SMS requests.
+Slowness that never reproduces locally has to be caught in production, so a fraction of the inbound
+messages can be profiled without redeploying. The fraction comes from PROFILE_SAMPLE_RATE (0 is off),
+and the admin dashboard can change it at any time. The admin setting is saved in PROFILE_DIR, so every
+worker process on the dyno picks it up within a few seconds.
+
+Each sampled message is profiled two ways:
+- cProfile, aggregated into a pstats file (open it with `python -m pstats` or snakeviz)
+- a stack sampler thread that records the message's call stack every PROFILE_INTERVAL_MS, written as
+  collapsed stacks ("frame;frame;frame count" lines, for flamegraph.pl or speedscope)
+
+Every PROFILE_ROTATE_SECONDS the aggregates are written to a new pair of files in PROFILE_DIR, and only
+the newest PROFILE_KEEP_FILES of each kind are kept. The admin dashboard lists them for download.
+Messages that aren't sampled only pay for a random() call.
+"""
+
+import os
+import re
+import sys
+import time
+import atexit
+import random
+import pstats
+import cProfile
+import functools
+import threading
+from collections import Counter
+
+# Fraction of messages profiled (0 to 1). The admin dashboard overrides it.
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+# Directory the profiles (and the admin's sample rate) are written to
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# How often (in seconds) the aggregated profiles are written to new files
+PROFILE_ROTATE_SECONDS = float(os.environ.get("PROFILE_ROTATE_SECONDS", "300"))
+# How many files of each kind (pstats, collapsed stacks) are kept
+PROFILE_KEEP_FILES = int(os.environ.get("PROFILE_KEEP_FILES", "24"))
+# Milliseconds between two samples of a profiled message's call stack
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+
+# The file the admin's sample rate is saved to, and how often workers check it
+RATE_FILENAME = "sample_rate"
+RATE_CHECK_SECONDS = 5
+# Profile files are named profile-<time>-<pid>.pstats / .collapsed
+PROFILE_FILENAME = re.compile(r"^profile-\d{8}-\d{6}-\d+\.(pstats|collapsed)$")
+
+
+class RequestProfiler:
+    def __init__(self, directory=PROFILE_DIR, rate=PROFILE_SAMPLE_RATE):
+        self.directory = directory
+        self.default_rate = rate
+        self.rate = rate
+        self.rate_checked_at = 0.0
+        self.rate_mtime = None
+        self.lock = threading.Lock()
+        # This window's aggregates, written to files when it ends
+        self.profile_stats = None
+        self.stacks = Counter()
+        self.window_started = time.monotonic()
+        # Thread id -> the profiled message's thread, sampled by the stack sampler
+        self.active = {}
+        self.sampler_pid = None
+        self.sampler_wakeup = threading.Event()
+        self.registered_atexit = False
+        # Counters for monitoring
+        self.sampled = 0
+        self.skipped = 0
+
+    def sample(self, function):
+        """Decorator profiling a fraction of the calls of function."""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if random.random() >= self.current_rate():
+                return function(*args, **kwargs)
+            return self._profile(function, args, kwargs)
+        return wrapper
+
+    def current_rate(self):
+        # The admin's rate is re-read when the file changes, checking at most every RATE_CHECK_SECONDS
+        now = time.monotonic()
+        if now - self.rate_checked_at >= RATE_CHECK_SECONDS:
+            self.rate_checked_at = now
+            try:
+                path = os.path.join(self.directory, RATE_FILENAME)
+                mtime = os.path.getmtime(path)
+                if mtime != self.rate_mtime:
+                    with open(path, encoding="utf-8") as f:
+                        self.rate = min(1.0, max(0.0, float(f.read().strip())))
+                    self.rate_mtime = mtime
+            except (OSError, ValueError):
+                self.rate, self.rate_mtime = self.default_rate, None
+        return self.rate
+
+    def set_rate(self, rate):
+        """Sets the sample rate of every worker process, from the admin dashboard."""
+        rate = min(1.0, max(0.0, float(rate)))
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, RATE_FILENAME), "w", encoding="utf-8") as f:
+            f.write(str(rate))
+        self.rate, self.rate_checked_at = rate, 0.0
+        return rate
+
+    def _profile(self, function, args, kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another message is being profiled by cProfile on another thread (Python 3.12+ allows one at a time)
+            self.skipped += 1
+            return function(*args, **kwargs)
+        self._ensure_sampler()
+        thread_id = threading.get_ident()
+        self.active[thread_id] = True
+        self.sampler_wakeup.set()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            self.active.pop(thread_id, None)
+            self._add(profile)
+
+    def _add(self, profile):
+        with self.lock:
+            self.sampled += 1
+            if self.profile_stats is None:
+                self.profile_stats = pstats.Stats(profile)
+            else:
+                self.profile_stats.add(profile)
+            rotate = time.monotonic() - self.window_started >= PROFILE_ROTATE_SECONDS
+        if rotate:
+            self.flush()
+
+    # The stack sampler thread is started lazily, so each gunicorn worker starts its own after forking
+    def _ensure_sampler(self):
+        if self.sampler_pid == os.getpid():
+            return
+        with self.lock:
+            if self.sampler_pid == os.getpid():
+                return
+            self.active = {}
+            threading.Thread(target=self._run_sampler, name="stack-sampler", daemon=True).start()
+            self.sampler_pid = os.getpid()
+        if not self.registered_atexit:
+            # Write the last window when the worker shuts down
+            atexit.register(self.flush)
+            self.registered_atexit = True
+
+    def _run_sampler(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        while True:
+            # Sleep until a message is being profiled
+            if not self.active:
+                self.sampler_wakeup.wait()
+                self.sampler_wakeup.clear()
+                continue
+            frames = sys._current_frames()
+            stacks = [_collapse(frames[thread_id]) for thread_id in list(self.active) if thread_id in frames]
+            with self.lock:
+                self.stacks.update(stacks)
+            time.sleep(interval)
+
+    def flush(self):
+        """Writes this window's aggregated profiles to new files, and starts a new window."""
+        with self.lock:
+            stats, stacks = self.profile_stats, self.stacks
+            self.profile_stats, self.stacks = None, Counter()
+            self.window_started = time.monotonic()
+        if stats is None and not stacks:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            name = os.path.join(self.directory, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+            if stats is not None:
+                stats.dump_stats(name + ".pstats")
+            if stacks:
+                with open(name + ".collapsed", "w", encoding="utf-8") as f:
+                    f.writelines(f"{stack} {count}\n" for stack, count in stacks.most_common())
+            self._remove_old_files()
+        except OSError as e:
+            print(f"Error writing a profile: {e}", file=sys.stderr)
+
+    def _remove_old_files(self):
+        for extension in ("pstats", "collapsed"):
+            names = sorted(name for name in self.files() if name.endswith("." + extension))
+            for name in names[:-PROFILE_KEEP_FILES]:
+                os.remove(os.path.join(self.directory, name))
+
+    def files(self):
+        """The names of the profile files, newest first."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted((name for name in names if PROFILE_FILENAME.match(name)), reverse=True)
+
+    def stats(self):
+        return {"rate": self.current_rate(), "sampled": self.sampled, "skipped": self.skipped, "files": len(self.files())}
+
+
+# A stack as "module:function;module:function", outermost frame first
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,196 @@
+# query_budget.py
+
+"""
+This file contains the SQL query budget of the inbound SMS path.
+Each message is expected to run a small, fixed number of SQL statements and a single commit: look up
+the user and their session, whatever the state needs, then write the changes in one transaction.
+A query added by a change (a lookup moved into a loop, a second commit, a relationship loaded lazily)
+is easy to miss in review and only shows up as latency in production.
+
+With SQL_QUERY_BUDGET set to "warn" or "enforce", the statements and commits of each message are
+counted (per thread, so background writers aren't), and checked:
+- against the budget of the state the message arrived in (STATE_BUDGETS, or DEFAULT_BUDGET)
+- for N+1 patterns: the same statement run more than QUERY_REPEAT_LIMIT times in one message
+  (an executemany is one statement)
+
+Events are left out of both checks. With EVENT_BUFFER_ENABLED=0 each event is inserted by its own
+autoflush, so their number depends on how many events a state logs, not on its queries. So is the
+advisory lock SMS_SERIALIZE_USERS takes on Postgres, which depends on the deployment, not the state.
+
+process_message calls check() right before its unit of work commits, after flushing the writes.
+"enforce" raises QueryBudgetExceeded there, so the transaction rolls back and nothing the message
+changed is kept; it's meant for tests and staging. "warn" prints the violations to stderr.
+Commits made after the check (there should be just the one) are checked when the message is done,
+and can only be reported. The default, "off", doesn't count anything.
+"""
+
+import os
+import sys
+import functools
+import threading
+from collections import Counter, namedtuple
+from sqlalchemy import event
+
+# "off", "warn" or "enforce"
+SQL_QUERY_BUDGET = os.environ.get("SQL_QUERY_BUDGET", "off")
+# The most times one statement may run in a message before it counts as an N+1 pattern
+QUERY_REPEAT_LIMIT = int(os.environ.get("QUERY_REPEAT_LIMIT", "2"))
+
+QueryBudget = namedtuple("QueryBudget", ["statements", "commits"])
+
+# The budget of each state: the most statements (events and advisory locks aside) and commits a message
+# arriving in that state runs today, measured on every path through the state, with EVENT_BUFFER_ENABLED on
+# and off (the counts are the same). They include the user and session lookups, the state's own queries,
+# and the writes of the commit. Raise a state's budget only together with the change that needs it.
+STATE_BUDGETS = {
+    # A new user's first message also inserts the user and their first session
+    "PRE-REGISTRATION": QueryBudget(statements=6, commits=1),
+    "REGISTRATION": QueryBudget(statements=5, commits=1),
+    "ASK_RACE_ETHNICITY": QueryBudget(statements=5, commits=1),
+    "ASK_MULTIRACIAL1": QueryBudget(statements=5, commits=1),
+    "ASK_MULTIRACIAL2": QueryBudget(statements=5, commits=1),
+    "ASK_GENDER": QueryBudget(statements=5, commits=1),
+    "ASK_GENDER_OTHER": QueryBudget(statements=4, commits=1),
+    "ASK_AGE_GROUP": QueryBudget(statements=5, commits=1),
+    # Checks whether the user is subscribed to alerts
+    "MAIN_MENU": QueryBudget(statements=5, commits=1),
+    # An expired session: also inserts the new session
+    "RETURNING_USER": QueryBudget(statements=4, commits=1),
+    "RESOURCE_MENU": QueryBudget(statements=3, commits=1),
+    "ZIPCODE_INPUT": QueryBudget(statements=3, commits=1),
+    "RESOURCE_VIEW": QueryBudget(statements=3, commits=1),
+    "HELPLINE_MENU": QueryBudget(statements=3, commits=1),
+    "HELPLINE_VIEW": QueryBudget(statements=3, commits=1),
+    # Add the user's alert subscription, or look up and remove it, or look up the latest alert
+    "NEW_ALERTS_USER": QueryBudget(statements=4, commits=1),
+    "EXISTING_ALERTS_USER": QueryBudget(statements=5, commits=1),
+    "OPT-OUT": QueryBudget(statements=3, commits=1),
+}
+# The budget of a state that isn't listed above
+DEFAULT_BUDGET = QueryBudget(statements=6, commits=1)
+
+# Event inserts, which aren't counted against the budget
+EVENT_INSERT = "INSERT INTO events "
+# The advisory lock of SMS_SERIALIZE_USERS on Postgres (see user_serialization.py), which isn't either
+ADVISORY_LOCK = "SELECT pg_advisory_xact_lock("
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+class QueryCount:
+    """The statements and commits of one message."""
+    def __init__(self):
+        self.state = None
+        self.statements = Counter()
+        self.event_inserts = 0
+        self.commits = 0
+        self.reported = set()
+
+    def total(self):
+        return sum(self.statements.values())
+
+    def violations(self, pending_commits=0):
+        budget = STATE_BUDGETS.get(self.state, DEFAULT_BUDGET)
+        violations = []
+        if self.total() > budget.statements:
+            violations.append(f"{self.total()} statements, over the budget of {budget.statements}")
+        if self.commits + pending_commits > budget.commits:
+            violations.append(f"{self.commits + pending_commits} commits, over the budget of {budget.commits}")
+        for statement, count in self.statements.items():
+            if count > QUERY_REPEAT_LIMIT:
+                violations.append(f"N+1: ran {count} times: {' '.join(statement.split())[:200]}")
+        return violations
+
+
+class QueryBudgetGuard:
+    def __init__(self, mode=SQL_QUERY_BUDGET):
+        if mode not in ("off", "warn", "enforce"):
+            raise ValueError(f"Unknown SQL_QUERY_BUDGET {mode!r}, expected 'off', 'warn' or 'enforce'")
+        self.mode = mode
+        self.current = threading.local()
+        # Counters for monitoring
+        self.checked = 0
+        self.exceeded = 0
+
+    def init_app(self, app):
+        if self.mode == "off":
+            return
+        from database import db
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", self._on_statement)
+        event.listen(engine, "commit", self._on_commit)
+
+    def guard(self, function):
+        """Decorator counting the statements and commits of each call of function (one message)."""
+        if self.mode == "off":
+            return function
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            count = self.current.count = QueryCount()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                self.current.count = None
+            # Anything that went over after check(), such as a second commit, is already committed,
+            # so it's only reported, even in enforce mode
+            self._report(count, count.violations(), enforce=False)
+            return result
+        return wrapper
+
+    def label_state(self, state):
+        """Records the state the message being handled arrived in, which decides its budget."""
+        count = getattr(self.current, "count", None)
+        if count is not None:
+            count.state = state
+
+    def check(self, session):
+        """
+        Called in the unit of work, right before it commits. Flushes the pending writes so they're
+        counted, and checks the message against its budget, counting the commit that's about to happen.
+        """
+        count = getattr(self.current, "count", None)
+        if count is None:
+            return
+        session.flush()
+        self.checked += 1
+        self._report(count, count.violations(pending_commits=1), enforce=self.mode == "enforce")
+
+    def counts(self):
+        """The statements and commits of the message being handled so far, or None."""
+        return getattr(self.current, "count", None)
+
+    def _on_statement(self, conn, cursor, statement, parameters, context, executemany):
+        count = getattr(self.current, "count", None)
+        if count is None:
+            return
+        if statement.startswith(EVENT_INSERT):
+            count.event_inserts += 1
+        elif not statement.startswith(ADVISORY_LOCK):
+            count.statements[statement] += 1
+
+    def _on_commit(self, conn):
+        count = getattr(self.current, "count", None)
+        if count is not None:
+            count.commits += 1
+
+    # Each violation is reported once per message
+    def _report(self, count, violations, enforce):
+        violations = [violation for violation in violations if violation not in count.reported]
+        if not violations:
+            return
+        if not count.reported:
+            self.exceeded += 1
+        count.reported.update(violations)
+        message = f"SQL query budget exceeded in state {count.state}: " + "; ".join(violations)
+        if enforce:
+            raise QueryBudgetExceeded(message)
+        print(message, file=sys.stderr)
+
+    def stats(self):
+        return {"mode": self.mode, "checked": self.checked, "exceeded": self.exceeded}
+
+
+query_budget = QueryBudgetGuard()
@@ -0,0 +1,86 @@
+# reply_cache.py
+
+"""
+This file contains a bounded cache for rendered chatbot replies.
+Entries are evicted least-recently-used once the cache is full, and expire after a TTL.
+Hit, miss, eviction and expiration counters are kept so the cache can be monitored.
+"""
+
+import time
+import threading
+from cachetools import Cache, TTLCache
+
+
+class CountingTTLCache(TTLCache):
+    """A cachetools TTLCache that counts the entries it evicts and expires."""
+    def __init__(self, maxsize, ttl, timer=time.monotonic):
+        super().__init__(maxsize=maxsize, ttl=ttl, timer=timer)
+        self.evictions = 0
+        self.expirations = 0
+
+    # Called when the cache is full and the least recently used entry must go
+    def popitem(self):
+        key, value = super().popitem()
+        self.evictions += 1
+        return key, value
+
+    # Clearing pops every entry, which shouldn't count as evictions
+    def clear(self):
+        evictions = self.evictions
+        super().clear()
+        self.evictions = evictions
+
+    # Called before every access to drop the entries older than the TTL.
+    # cachetools 5.3 returns None here (later versions return the expired items), so count by size.
+    # Cache.__len__ is the stored size; TTLCache.__len__ would expire (and call this) again.
+    def expire(self, time=None):
+        size = Cache.__len__(self)
+        expired = super().expire(time)
+        self.expirations += size - Cache.__len__(self)
+        return expired
+
+
+class ReplyCache:
+    """
+    Memoizes replies by key. get_or_compute() returns the cached reply for a key,
+    or computes, stores and returns it.
+    """
+    def __init__(self, maxsize, ttl):
+        self.cache = CountingTTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        # cachetools caches are not thread-safe
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, key, compute, should_cache=None):
+        """
+        compute() is called outside the lock, so a slow computation doesn't block other lookups.
+        If should_cache is given, a computed reply is only stored when should_cache(reply) is true.
+        """
+        with self.lock:
+            try:
+                reply = self.cache[key]
+                self.hits += 1
+                return reply
+            except KeyError:
+                self.misses += 1
+        reply = compute()
+        if should_cache is None or should_cache(reply):
+            with self.lock:
+                self.cache[key] = reply
+        return reply
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.cache.evictions,
+                "expirations": self.cache.expirations,
+                "size": len(self.cache),
+                "maxsize": self.cache.maxsize,
+            }
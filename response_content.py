@@ -79,6 +79,17 @@ zipcode_input_message = (
     "What zipcode are you looking for? Reply with the Massachusetts zipcode."
 )
 
+# Resource lookup error for a zipcode that isn't in the Massachusetts zipcode shapefile
+zipcode_not_found = "⚠️ MA zipcode {zipcode} not found in shapefil. Check with the chatbot administrator if there's an issue."
+
+# Resource lookup error when the precomputed answer table hasn't been built
+resource_lookup_unavailable = "⚠️ Resource lookups are unavailable right now. Notify the chatbot administrator that the resource answer table is missing."
+
+# One resource in a resource lookup reply, followed by its estimated distance
+resource_snippet = "{name}\n{address}\n{phone}\n"
+resource_inside_zipcode = "Estimated distance: inside zipcode {zipcode}\n---\n"
+resource_distance = "Estimated distance: {distance_miles:.1f} miles away\n---\n"
+
 # Emoji dictionary for the chatbot. This is used to add an emoji to the beginning of the resource view response.
 emoji_dict = {
     "Syringe Service Program": "💉",
@@ -162,6 +173,10 @@ already_subscribed_to_alerts_boilerplate = (
     "Reply 'Menu' to return to the chatbot main menu."
 )
 
+# The emergency alerts menu, for users who aren't subscribed and for users who are
+not_signed_up_for_alerts = "You are not signed up for emergency alerts.\n\n" + not_subscribed_to_alerts_boilerplate
+already_signed_up_for_alerts = "You are already signed up for emergency alerts.\n\n" + already_subscribed_to_alerts_boilerplate
+
 # What the user sees when they are added to the emergency alerts list
 added_to_alerts = (
     "You have been added to the emergency alerts list. The chatbot administrator will send out mass texts if new risks in the drug supply appear.\n\n"
@@ -0,0 +1,218 @@
+# session_store.py
+
+"""
+This file contains the pluggable conversation-state store.
+Reading and writing SMSUserSession rows in Postgres on every message is the slowest part of a reply,
+so the current state of each conversation can be kept in a faster store instead:
+
+- "database" (default): no store, every message reads and writes the sessions table as before
+- "memory": an in-process dict. Only correct with a single gunicorn worker
+- "redis": a Redis server at REDIS_URL, shared by every worker
+
+Entries expire after SESSION_TTL_SECONDS, the same 30 minutes as is_session_expired(), so a miss
+means the session is expired (or was never cached) and the database decides what happens next.
+Changes are still persisted to the sessions table for analytics, but asynchronously: a background
+thread writes the latest state of each changed session in bulk (write-behind).
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from datetime import datetime
+from sqlalchemy import bindparam
+from database import db, SMSUserSession
+
+SESSION_STORE = os.environ.get("SESSION_STORE", "database")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+# Matches the 30 minute expiry in chatbot_utils.is_session_expired()
+SESSION_TTL_SECONDS = 30 * 60
+# How often (in seconds) changed sessions are written to the database
+SESSION_WRITE_BEHIND_INTERVAL = float(os.environ.get("SESSION_WRITE_BEHIND_INTERVAL", "2"))
+
+# The SMSUserSession columns kept in the store
+SESSION_FIELDS = ("id", "hashed_phone_number", "state", "last_interaction", "first_interaction",
+                  "resource_category", "page_number", "helpline_program")
+# The columns that change during a conversation, and are written behind to the database
+PERSISTED_FIELDS = ("state", "last_interaction", "first_interaction", "resource_category", "page_number", "helpline_program")
+
+
+class SessionState:
+    """
+    A plain copy of an SMSUserSession row. The state handlers read and change it
+    exactly like the row itself (user_session.state = ..., user_session.id, ...).
+    """
+    __slots__ = SESSION_FIELDS
+
+    def __init__(self, **values):
+        for field in SESSION_FIELDS:
+            setattr(self, field, values.get(field))
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(**{field: getattr(row, field) for field in SESSION_FIELDS})
+
+    def to_json(self):
+        values = {field: getattr(self, field) for field in SESSION_FIELDS}
+        if values["last_interaction"] is not None:
+            values["last_interaction"] = values["last_interaction"].isoformat()
+        return json.dumps(values)
+
+    @classmethod
+    def from_json(cls, data):
+        values = json.loads(data)
+        if values.get("last_interaction"):
+            values["last_interaction"] = datetime.fromisoformat(values["last_interaction"])
+        return cls(**values)
+
+
+class InProcessSessionStore:
+    """Conversation state in a dict, keyed by hashed phone number. For single-worker deployments."""
+    def __init__(self, ttl=SESSION_TTL_SECONDS):
+        self.ttl = ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, hashed_phone_number):
+        with self.lock:
+            entry = self.sessions.get(hashed_phone_number)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self.sessions[hashed_phone_number]
+                return None
+        # Each caller gets its own copy, like a row read from the database
+        return SessionState.from_json(data)
+
+    def put(self, user_session):
+        with self.lock:
+            self.sessions[user_session.hashed_phone_number] = (user_session.to_json(), time.monotonic() + self.ttl)
+
+    def delete(self, hashed_phone_number):
+        with self.lock:
+            self.sessions.pop(hashed_phone_number, None)
+
+
+class RedisSessionStore:
+    """
+    Conversation state in Redis, shared by every worker. Each session is a JSON string with a TTL.
+    A client can be passed in (for example fakeredis.FakeRedis() in tests), otherwise one is made from REDIS_URL.
+    """
+    def __init__(self, client=None, url=REDIS_URL, ttl=SESSION_TTL_SECONDS, prefix="sms_session:"):
+        if client is None:
+            # Only deployments that use Redis need the client library
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, hashed_phone_number):
+        data = self.client.get(self.prefix + hashed_phone_number)
+        if data is None:
+            return None
+        return SessionState.from_json(data)
+
+    def put(self, user_session):
+        self.client.set(self.prefix + user_session.hashed_phone_number, user_session.to_json(), ex=self.ttl)
+
+    def delete(self, hashed_phone_number):
+        self.client.delete(self.prefix + hashed_phone_number)
+
+
+class SessionWriteBehind:
+    """
+    Persists changed sessions to the sessions table from a background thread.
+    Several changes to the same session between flushes are coalesced into one UPDATE row,
+    and each flush writes all of them with a single executemany.
+    """
+    def __init__(self, interval=SESSION_WRITE_BEHIND_INTERVAL):
+        self.interval = interval
+        self.app = None
+        # Session id -> latest values of PERSISTED_FIELDS
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+        self.registered_atexit = False
+        self.written = 0
+        self.failed_flushes = 0
+
+    def init_app(self, app):
+        self.app = app
+
+    def enqueue(self, user_session):
+        self._ensure_thread()
+        with self.lock:
+            self.pending[user_session.id] = {field: getattr(user_session, field) for field in PERSISTED_FIELDS}
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        with self.flush_lock:
+            rows = [dict(values, session_id=session_id) for session_id, values in pending.items()]
+            table = SMSUserSession.__table__
+            statement = (table.update()
+                         .where(table.c.id == bindparam("session_id"))
+                         .values({field: bindparam(field) for field in PERSISTED_FIELDS}))
+            try:
+                with self.app.app_context():
+                    with db.engine.begin() as connection:
+                        connection.execute(statement, rows)
+                self.written += len(rows)
+            except Exception as e:
+                self.failed_flushes += 1
+                print(f"Error writing {len(rows)} sessions, retrying on the next flush: {e}", file=sys.stderr)
+                # Put them back, unless a newer change to the same session arrived in the meantime
+                with self.lock:
+                    for session_id, values in pending.items():
+                        self.pending.setdefault(session_id, values)
+
+    # The thread is started lazily, so each gunicorn worker starts its own after forking
+    def _ensure_thread(self):
+        if self.thread is not None and self.thread_pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.thread_pid == os.getpid() and self.thread.is_alive():
+                return
+            self.thread_pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name="session-write-behind", daemon=True)
+            self.thread.start()
+        if not self.registered_atexit:
+            # Write out the remaining changes when the worker shuts down
+            atexit.register(self.flush)
+            self.registered_atexit = True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error in the session write-behind: {e}", file=sys.stderr)
+
+    def stats(self):
+        with self.lock:
+            pending = len(self.pending)
+        return {"pending": pending, "written": self.written, "failed_flushes": self.failed_flushes}
+
+
+def make_session_store(kind=SESSION_STORE):
+    if kind == "memory":
+        return InProcessSessionStore()
+    if kind == "redis":
+        return RedisSessionStore()
+    if kind == "database":
+        return None
+    raise ValueError(f"Unknown SESSION_STORE {kind!r}, expected 'database', 'memory' or 'redis'")
+
+
+# None when conversation state lives only in the database
+session_store = make_session_store()
+session_write_behind = SessionWriteBehind()
@@ -25,3 +25,35 @@ document.querySelector('#emergencyAlertForm').addEventListener('submit', functio
         event.preventDefault(); // Prevent form submission if confirmSendMessage returns false
     }
 });
+
+// Refreshes the progress of alert broadcasts that are still sending on the admin dashboard
+function refreshBroadcasts() {
+    const rows = document.querySelectorAll('#broadcastsTable tr[data-status="sending"]');
+    rows.forEach((row) => {
+        fetch(row.dataset.broadcastUrl, { credentials: 'same-origin' })
+            .then((response) => response.json())
+            .then((progress) => {
+                const counts = progress.counts;
+                const fields = {
+                    status: progress.status,
+                    sent: counts.sent,
+                    failed: counts.failed + counts.unknown,
+                    skipped: counts.skipped,
+                    pending: counts.pending + counts.sending,
+                    total: progress.total,
+                    rate: progress.messages_per_second ?? '',
+                };
+                for (const [field, value] of Object.entries(fields)) {
+                    row.querySelector(`[data-field="${field}"]`).textContent = value;
+                }
+                row.dataset.status = progress.status;
+            })
+            .catch(() => {});
+    });
+    if (rows.length > 0) {
+        setTimeout(refreshBroadcasts, 3000);
+    }
+}
+if (document.querySelector('#broadcastsTable')) {
+    setTimeout(refreshBroadcasts, 3000);
+}
@@ -0,0 +1,88 @@
+# tests/conftest.py
+
+"""
+Shared test setup. The modules live at the top of the repository, so it's put on sys.path.
+
+app.py configures itself from the environment when it's imported, so the environment is set here
+first: a throwaway SQLite database, a test salt, no broadcast resumer, and the SQL query budget
+enforced, so every message the tests send is checked against its state's budget.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import tempfile
+import threading
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_directory = tempfile.mkdtemp(prefix="chatbot-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_directory, 'test.db')}"
+os.environ["EVENT_SPILL_PATH"] = os.path.join(_directory, "event_spill.jsonl")
+os.environ["PROFILE_DIR"] = os.path.join(_directory, "profiles")
+os.environ.setdefault("FIXED_SALT", "test-salt")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ["BROADCAST_RESUME"] = "0"
+os.environ["SQL_QUERY_BUDGET"] = "enforce"
+
+import pytest
+from aiohttp import web
+
+
+@pytest.fixture(scope="session")
+def app():
+    from app import app
+    app.config["TESTING"] = True
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield
+
+
+class FakeTwilioServer:
+    """fake_twilio.make_app(**options) served on a free port by a background thread."""
+    def __init__(self, **options):
+        import fake_twilio
+        self.loop = asyncio.new_event_loop()
+        self.runner = web.AppRunner(fake_twilio.make_app(**options))
+        self.loop.run_until_complete(self.runner.setup())
+        self.loop.run_until_complete(web.TCPSite(self.runner, "127.0.0.1", 0).start())
+        self.base = f"http://127.0.0.1:{self.runner.addresses[0][1]}"
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    # The messages accepted so far, in the order they arrived
+    def messages(self):
+        with urllib.request.urlopen(f"{self.base}/messages") as response:
+            return json.load(response)["messages"]
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+@pytest.fixture
+def twilio(request, monkeypatch):
+    """
+    A fake Twilio, which alert broadcasts and deferred replies send to.
+    Parametrize it indirectly to pass options to make_app (failure rates, Retry-After).
+    """
+    import alert_broadcast
+    import deferred_replies
+    server = FakeTwilioServer(**dict({"latency_ms": 0}, **getattr(request, "param", {})))
+    monkeypatch.setattr(alert_broadcast, "TWILIO_API_BASE", server.base)
+    monkeypatch.setattr(deferred_replies, "TWILIO_API_BASE", server.base)
+    monkeypatch.setenv("TWILIO_ACCOUNT_SID", "AC123")
+    yield server
+    server.stop()
@@ -0,0 +1,119 @@
+# tests/test_alert_broadcast.py
+
+import asyncio
+import threading
+from datetime import datetime
+import pytest
+import alert_broadcast
+from alert_broadcast import BroadcastJob, resume_stale_broadcasts, start_broadcast
+from database import db, AlertDelivery, EmergencyAlerts, EmergencyAlertUsers
+
+
+@pytest.fixture
+def broadcasts(app, monkeypatch):
+    """
+    An app context with no subscribers or alerts. Broadcasts don't start a thread:
+    the ids of the alerts launched are collected, to be run with run_broadcast().
+    """
+    launched = []
+    monkeypatch.setattr(alert_broadcast, "launch_broadcast", lambda app, alert_id: launched.append(alert_id))
+    with app.app_context():
+        for model in (AlertDelivery, EmergencyAlerts, EmergencyAlertUsers):
+            model.query.delete()
+        db.session.commit()
+        yield launched
+
+
+def sent_to(twilio):
+    return sorted(message["to"] for message in twilio.messages())
+
+
+def subscribe(*phone_numbers):
+    for phone_number in phone_numbers:
+        db.session.add(EmergencyAlertUsers(phone_number=phone_number, total_alerts=0, timestamp_user_created=datetime.now()))
+    db.session.commit()
+
+
+def run_broadcast(app, alert_id):
+    BroadcastJob(alert_id).run(app)
+    db.session.expire_all()
+    return db.session.get(EmergencyAlerts, alert_id)
+
+
+def test_heartbeat_is_refreshed_while_a_chunk_is_sent(app, broadcasts, monkeypatch):
+    monkeypatch.setattr(alert_broadcast, "BROADCAST_HEARTBEAT_SECONDS", 0.05)
+    monkeypatch.setattr(alert_broadcast, "BROADCAST_STALE_SECONDS", 0.3)
+
+    # A send that takes longer than BROADCAST_STALE_SECONDS, then checks for stale broadcasts as a resumer would
+    async def slow_send(session, rate_limiter, url, from_, phone_number, body, delivery_id):
+        await asyncio.sleep(0.6)
+        resume_stale_broadcasts(app)
+        return {"id": delivery_id, "status": "sent", "attempts": 1, "twilio_sid": "SM1", "error": None}
+
+    # The heartbeat is written off the event loop's thread, so the sends aren't held up
+    heartbeat_threads = []
+    write_heartbeat = BroadcastJob._write_heartbeat
+    def recorded_write_heartbeat(job, engine):
+        heartbeat_threads.append(threading.current_thread())
+        write_heartbeat(job, engine)
+
+    monkeypatch.setattr(alert_broadcast, "send_with_retries", slow_send)
+    monkeypatch.setattr(BroadcastJob, "_write_heartbeat", recorded_write_heartbeat)
+    subscribe("+15550000001")
+    start_broadcast(app, "Alert", "Alert")
+    alert = run_broadcast(app, broadcasts.pop())
+    assert alert.status == 'complete'
+    assert broadcasts == []
+    assert heartbeat_threads and threading.current_thread() not in heartbeat_threads
+
+
+def test_a_stale_broadcast_is_claimed_once(app, broadcasts, monkeypatch):
+    monkeypatch.setattr(alert_broadcast, "BROADCAST_STALE_SECONDS", 0)
+    subscribe("+15550000001")
+    alert_id = start_broadcast(app, "Alert", "Alert").id
+    broadcasts.clear()
+    resume_stale_broadcasts(app)
+    # The first claim bumped the heartbeat, so the alert isn't stale any more for the second check
+    monkeypatch.setattr(alert_broadcast, "BROADCAST_STALE_SECONDS", 60)
+    resume_stale_broadcasts(app)
+    assert broadcasts == [alert_id]
+
+
+PHONE_NUMBERS = [f"+1555000{n:04d}" for n in range(5)]
+
+
+def test_broadcast_sends_once_to_each_subscriber(app, broadcasts, twilio, monkeypatch):
+    monkeypatch.setattr(alert_broadcast, "BROADCAST_CHECKPOINT_SIZE", 2)
+    monkeypatch.setattr(alert_broadcast, "BROADCAST_MESSAGES_PER_SECOND", 1000)
+    subscribe(*PHONE_NUMBERS)
+    start_broadcast(app, "Alert", "Alert")
+    alert = run_broadcast(app, broadcasts.pop())
+
+    assert sent_to(twilio) == PHONE_NUMBERS
+    assert (alert.status, alert.number_of_users_sent, alert.total_recipients) == ('complete', 5, 5)
+    assert [subscriber.total_alerts for subscriber in EmergencyAlertUsers.query] == [1] * 5
+    assert {delivery.status for delivery in AlertDelivery.query} == {'sent'}
+
+
+def test_resumed_broadcast_skips_the_subscribers_already_sent(app, broadcasts, twilio, monkeypatch):
+    monkeypatch.setattr(alert_broadcast, "BROADCAST_CHECKPOINT_SIZE", 2)
+    monkeypatch.setattr(alert_broadcast, "BROADCAST_MESSAGES_PER_SECOND", 1000)
+    subscribe(*PHONE_NUMBERS)
+    start_broadcast(app, "Alert", "Alert")
+    alert_id = broadcasts.pop()
+
+    # The worker dies right after its first checkpoint
+    checkpoint = BroadcastJob._checkpoint
+    def checkpoint_then_die(job, chunk, outcomes):
+        checkpoint(job, chunk, outcomes)
+        raise RuntimeError("worker died")
+    monkeypatch.setattr(BroadcastJob, "_checkpoint", checkpoint_then_die)
+    alert = run_broadcast(app, alert_id)
+    assert (alert.status, alert.number_of_users_sent) == ('sending', 2)
+    assert sent_to(twilio) == PHONE_NUMBERS[:2]
+
+    monkeypatch.setattr(BroadcastJob, "_checkpoint", checkpoint)
+    alert = run_broadcast(app, alert_id)
+    assert sent_to(twilio) == PHONE_NUMBERS
+    assert (alert.status, alert.number_of_users_sent) == ('complete', 5)
+    assert [subscriber.total_alerts for subscriber in EmergencyAlertUsers.query] == [1] * 5
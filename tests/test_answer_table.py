@@ -0,0 +1,58 @@
+# tests/test_answer_table.py
+
+import os
+import json
+import pytest
+import answer_table
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    """A resources CSV and a shapefile directory, in place of the real ones."""
+    csv_path = tmp_path / "resources_data.csv"
+    csv_path.write_text("organization_name,address\nFood Bank,1 Main St\n")
+    shapefile = tmp_path / "zipcodes_shapefile"
+    shapefile.mkdir()
+    (shapefile / "MA_zipcodes.shx").write_bytes(b"\x00\x01\x02")
+    monkeypatch.setattr(answer_table, "RESOURCES_CSV_PATH", str(csv_path))
+    monkeypatch.setattr(answer_table, "ZIPCODE_SHAPEFILE_PATH", str(shapefile))
+    return csv_path, shapefile
+
+
+def touch(path, seconds):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10**9))
+
+
+def test_new_mtimes_keep_the_version(sources):
+    csv_path, shapefile = sources
+    version = answer_table.dataset_version()
+    # What a git checkout or slug extraction does
+    touch(csv_path, 3600)
+    touch(shapefile / "MA_zipcodes.shx", 3600)
+    assert answer_table.dataset_version() == version
+
+
+def test_changed_contents_change_the_version(sources):
+    csv_path, shapefile = sources
+    version = answer_table.dataset_version()
+    csv_path.write_text("organization_name,address\nFood Bank,2 Main St\n")
+    assert answer_table.dataset_version() != version
+    version = answer_table.dataset_version()
+    (shapefile / "MA_zipcodes.dbf").write_bytes(b"zipcodes")
+    assert answer_table.dataset_version() != version
+
+
+def test_checked_out_table_is_not_rebuilt(sources, tmp_path, monkeypatch):
+    csv_path, _ = sources
+    path = tmp_path / "resource_answers.json"
+    path.write_text(json.dumps({"version": answer_table.dataset_version(), "missing_coordinates": 0,
+                                "zipcodes": ["02139"], "resources": [], "answers": {}}))
+    touch(csv_path, 3600)
+    rebuilds = []
+    monkeypatch.setattr(answer_table, "ANSWER_TABLE_AUTO_REBUILD", True)
+    monkeypatch.setattr(answer_table, "_start_rebuild", rebuilds.append)
+    monkeypatch.setattr(answer_table, "_answer_table", None)
+    monkeypatch.setattr(answer_table, "_last_check", None)
+    assert answer_table.get_answer_table(str(path)).has_zipcode("02139")
+    assert rebuilds == []
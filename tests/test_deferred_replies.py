@@ -0,0 +1,57 @@
+# tests/test_deferred_replies.py
+
+import itertools
+from types import SimpleNamespace
+import pytest
+import deferred_replies
+import fake_twilio
+from deferred_replies import DeferredReplies, retry_delay, twiml_messages
+
+CONVERSATION = ["hi", "yes", "multiracial", "1"]
+
+
+def test_retry_delay_uses_retry_after():
+    assert retry_delay(0, "3") == 3.0
+    assert retry_delay(2, " 0 ") == 0.0
+
+
+def test_retry_delay_backs_off_with_jitter(monkeypatch):
+    monkeypatch.setattr(deferred_replies, "DEFERRED_REPLY_RETRY_BACKOFF", 1)
+    assert 0.5 <= retry_delay(0) < 1.5
+    assert 2 <= retry_delay(2) < 6
+    # A Retry-After that isn't a number of seconds (an HTTP date) falls back to the backoff
+    assert 0.5 <= retry_delay(0, "Wed, 21 Oct 2026 07:28:00 GMT") < 1.5
+
+
+@pytest.mark.parametrize("twilio", [{"rate_limit_rate": 0.5, "retry_after": 0}], indirect=True)
+def test_replies_stay_in_order_across_retries(app, client, twilio, monkeypatch):
+    # The replies a user gets to the conversation, from the webhook
+    expected = []
+    for body in CONVERSATION:
+        twiml = client.post("/sms", data={"From": "+15550007000", "Body": body}).data
+        expected.extend(text for text, _ in twiml_messages(twiml))
+    assert len(expected) >= len(CONVERSATION)
+
+    # Every other request to the fake is rate limited
+    rolls = itertools.cycle([0.0, 0.9])
+    monkeypatch.setattr(fake_twilio, "random", SimpleNamespace(random=lambda: next(rolls)))
+    delays = []
+    def recorded_retry_delay(attempt, retry_after=None):
+        delays.append(retry_delay(attempt, retry_after))
+        return delays[-1]
+    monkeypatch.setattr(deferred_replies, "retry_delay", recorded_retry_delay)
+
+    replies = DeferredReplies(workers=1)
+    replies.init_app(app)
+    phone_numbers = ["+15550007001", "+15550007002"]
+    for body in CONVERSATION:
+        for phone_number in phone_numbers:
+            replies.enqueue(phone_number, body)
+    replies.drain(timeout=30)
+
+    assert replies.stats() == {"queued": 0, "handled": 8, "failed": 0}
+    # Every retry waited the Retry-After of the 429 (0), not the backoff
+    assert delays and set(delays) == {0.0}
+    messages = twilio.messages()
+    for phone_number in phone_numbers:
+        assert [message["body"] for message in messages if message["to"] == phone_number] == expected
@@ -0,0 +1,8 @@
+# tests/test_import_budget.py
+
+from check_import_budget import FORBIDDEN_AT_BOOT, measure_imports
+
+
+def test_worker_boot_does_not_import_the_geo_stack():
+    imported = {name.split(".")[0] for _, _, _, name in measure_imports("chatbot")}
+    assert imported.isdisjoint(FORBIDDEN_AT_BOOT)
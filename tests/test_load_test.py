@@ -0,0 +1,49 @@
+# tests/test_load_test.py
+
+import asyncio
+import random
+import itertools
+import aiohttp
+import pytest
+from aiohttp import web
+import load_test
+from load_test import MULTIRACIAL_REGISTRATION, PATHS, REGISTRATION, Results, run_user
+
+_phone_numbers = itertools.count(15550200000)
+
+
+@pytest.mark.parametrize("registration", [REGISTRATION, MULTIRACIAL_REGISTRATION], ids=["registration", "multiracial"])
+@pytest.mark.parametrize("path", [path for path, _ in PATHS], ids=lambda path: path.__name__)
+def test_scripted_conversations_stay_on_script(client, registration, path):
+    random.seed(0)
+    phone_number = f"+{next(_phone_numbers)}"
+    for expected_state, body in registration + path():
+        response = client.post("/sms", data={"From": phone_number, "Body": body})
+        assert response.headers["X-Conversation-State"] == expected_state, body
+
+
+def test_off_script_latency_is_filed_under_the_actual_state(monkeypatch):
+    # A bot that is always in MAIN_MENU
+    async def sms(request):
+        return web.Response(text="<Response></Response>", headers={"X-Conversation-State": "MAIN_MENU"})
+
+    monkeypatch.setattr(load_test, "conversation", lambda: [("MAIN_MENU", "1"), ("RESOURCE_MENU", "2"), ("ZIPCODE_INPUT", "02139")])
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/sms", sms)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        results = Results()
+        try:
+            async with aiohttp.ClientSession() as session:
+                await run_user(session, f"http://127.0.0.1:{runner.addresses[0][1]}/sms", "+15550001234", results, 0)
+        finally:
+            await runner.cleanup()
+        return results
+
+    summary = asyncio.run(run()).summary(1.0)
+    # The second message was handled in MAIN_MENU, not RESOURCE_MENU, and the user stopped there
+    assert {state: stats["requests"] for state, stats in summary["states"].items()} == {"MAIN_MENU": 2}
+    assert summary["off_script"] == {"RESOURCE_MENU": 1}
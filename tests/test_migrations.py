@@ -0,0 +1,26 @@
+# tests/test_migrations.py
+
+import os
+import sqlalchemy as sa
+from alembic import command
+from alembic.config import Config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def alembic_config():
+    config = Config(os.path.join(ROOT, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(ROOT, "migrations"))
+    return config
+
+
+def test_upgrade_builds_a_fresh_database(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'fresh.db'}"
+    monkeypatch.setenv("DATABASE_URL", url)
+    command.upgrade(alembic_config(), "head")
+    inspector = sa.inspect(sa.create_engine(url))
+    assert {"users", "sessions", "events", "alert_users", "emergency_alerts", "alert_deliveries"} <= set(inspector.get_table_names())
+    assert "status" in {column["name"] for column in inspector.get_columns("emergency_alerts")}
+    assert "ix_alert_users_phone_number" in {index["name"] for index in inspector.get_indexes("alert_users")}
+    command.downgrade(alembic_config(), "base")
+    assert "users" not in sa.inspect(sa.create_engine(url)).get_table_names()
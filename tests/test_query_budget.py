@@ -0,0 +1,128 @@
+# tests/test_query_budget.py
+
+"""
+Drives every conversation state through the /sms webhook with SQL_QUERY_BUDGET=enforce (see conftest.py),
+with events buffered and unbuffered. A message over its budget raises QueryBudgetExceeded, failing the test.
+"""
+
+import itertools
+from datetime import datetime, timedelta
+import pytest
+import event_handlers
+import query_budget
+from chatbot_utils import hash_phone_number, get_latest_session
+from database import db
+from query_budget import QueryBudget, QueryBudgetExceeded, STATE_BUDGETS
+from state_handlers import conversation
+
+_phone_numbers = itertools.count(15550100000)
+
+# Each message, and the state the conversation is in after it
+CONVERSATION = [
+    ("hi", "REGISTRATION"),
+    ("yes", "ASK_RACE_ETHNICITY"),
+    ("multiracial", "ASK_MULTIRACIAL1"),
+    ("1", "ASK_MULTIRACIAL2"),
+    ("3", "ASK_GENDER"),
+    ("6", "ASK_GENDER_OTHER"),
+    ("nonbinary", "ASK_AGE_GROUP"),
+    ("2", "MAIN_MENU"),
+    ("1", "RESOURCE_MENU"),
+    ("1", "ZIPCODE_INPUT"),
+    ("02139", "ZIPCODE_INPUT"),
+    ("menu", "MAIN_MENU"),
+    ("2", "HELPLINE_MENU"),
+    ("2", "HELPLINE_VIEW"),
+    ("menu", "MAIN_MENU"),
+    ("3", "NEW_ALERTS_USER"),
+    ("add", "MAIN_MENU"),
+    ("3", "EXISTING_ALERTS_USER"),
+    ("latest", "MAIN_MENU"),
+    ("3", "EXISTING_ALERTS_USER"),
+    ("remove", "MAIN_MENU"),
+]
+
+
+@pytest.fixture(params=[True, False], ids=["buffered-events", "unbuffered-events"])
+def event_buffer(request, monkeypatch):
+    monkeypatch.setattr(event_handlers, "EVENT_BUFFER_ENABLED", request.param)
+    return request.param
+
+
+def new_phone_number():
+    return f"+{next(_phone_numbers)}"
+
+
+def send(client, phone_number, body):
+    response = client.post("/sms", data={"From": phone_number, "Body": body})
+    assert response.status_code == 200
+    return response
+
+
+def latest_session(app, phone_number):
+    with app.app_context():
+        return get_latest_session(hash_phone_number(phone_number))
+
+
+def set_session(app, phone_number, **values):
+    with app.app_context():
+        user_session = get_latest_session(hash_phone_number(phone_number))
+        for field, value in values.items():
+            setattr(user_session, field, value)
+        db.session.commit()
+
+
+def register(client, phone_number):
+    for body, _ in CONVERSATION[:CONVERSATION.index(("2", "MAIN_MENU")) + 1]:
+        send(client, phone_number, body)
+
+
+def test_conversation_stays_within_budget(app, client, event_buffer):
+    phone_number = new_phone_number()
+    for body, state in CONVERSATION:
+        send(client, phone_number, body)
+        assert latest_session(app, phone_number).state == state
+
+
+# Invalid responses, the other registration path, and opting out
+@pytest.mark.parametrize("bodies", [
+    ["hi", "zzz", "yes", "zzz", "1", "zzz", "1", "zzz", "1", "zzz", "2", "zzz", "1", "zzz", "zzz", "99999", "resources", "menu"],
+    ["hi", "no", "hi"],
+])
+def test_other_paths_stay_within_budget(client, event_buffer, bodies):
+    phone_number = new_phone_number()
+    for body in bodies:
+        send(client, phone_number, body)
+
+
+def test_every_state_has_a_budget():
+    assert set(conversation.states) | {"OPT-OUT"} == set(STATE_BUDGETS)
+
+
+def test_resource_view_stays_within_budget(app, client, event_buffer):
+    phone_number = new_phone_number()
+    register(client, phone_number)
+    # No transition leads to RESOURCE_VIEW, so the session is put there
+    set_session(app, phone_number, state="RESOURCE_VIEW", resource_category="1")
+    send(client, phone_number, "resources")
+    assert latest_session(app, phone_number).state == "RESOURCE_MENU"
+
+
+def test_returning_user_stays_within_budget(app, client, event_buffer):
+    phone_number = new_phone_number()
+    register(client, phone_number)
+    set_session(app, phone_number, last_interaction=datetime.now() - timedelta(hours=1))
+    send(client, phone_number, "hi")
+    assert latest_session(app, phone_number).state == "MAIN_MENU"
+
+
+def test_exceeding_the_budget_rolls_back(app, client, monkeypatch):
+    phone_number = new_phone_number()
+    register(client, phone_number)
+    session_id = latest_session(app, phone_number).id
+    monkeypatch.setitem(query_budget.STATE_BUDGETS, "MAIN_MENU", QueryBudget(statements=1, commits=1))
+    with pytest.raises(QueryBudgetExceeded):
+        client.post("/sms", data={"From": phone_number, "Body": "1"})
+    # The message was checked before its commit, so the transition to RESOURCE_MENU isn't kept
+    user_session = latest_session(app, phone_number)
+    assert (user_session.id, user_session.state) == (session_id, "MAIN_MENU")
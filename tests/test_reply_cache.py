@@ -0,0 +1,41 @@
+# tests/test_reply_cache.py
+
+from reply_cache import CountingTTLCache, ReplyCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_or_compute_stores_and_counts():
+    cache = ReplyCache(maxsize=4, ttl=60)
+    assert cache.get_or_compute("a", lambda: "reply a") == "reply a"
+    assert cache.get_or_compute("a", lambda: "recomputed") == "reply a"
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (1, 1, 1)
+
+
+def test_should_cache_false_is_not_stored():
+    cache = ReplyCache(maxsize=4, ttl=60)
+    cache.get_or_compute("a", lambda: "error", should_cache=lambda reply: False)
+    assert cache.stats()["size"] == 0
+
+
+def test_inserts_count_evictions_and_expirations():
+    timer = FakeTimer()
+    cache = CountingTTLCache(maxsize=2, ttl=10, timer=timer)
+    cache["a"] = 1
+    cache["b"] = 2
+    cache["c"] = 3
+    assert cache.evictions == 1
+    timer.now = 11
+    # Storing a value expires the old entries first
+    cache["d"] = 4
+    assert cache.expirations == 2
+    assert list(cache) == ["d"]
+    cache.clear()
+    assert cache.evictions == 1
@@ -0,0 +1,94 @@
+# tests/test_session_store.py
+
+import time
+from datetime import datetime
+import fakeredis
+import pytest
+import chatbot
+from chatbot_utils import hash_phone_number, get_latest_session
+from database import db, SMSUser, SMSUserSession
+from session_store import RedisSessionStore, SessionState, SessionWriteBehind
+
+
+def session_state(**values):
+    defaults = {"id": 1, "hashed_phone_number": "abc123", "state": "MAIN_MENU", "last_interaction": datetime(2026, 1, 2, 3, 4, 5),
+                "first_interaction": False, "resource_category": None, "page_number": None, "helpline_program": None}
+    return SessionState(**dict(defaults, **values))
+
+
+@pytest.fixture
+def redis_store():
+    return RedisSessionStore(client=fakeredis.FakeRedis(), ttl=60)
+
+
+def test_redis_put_and_get(redis_store):
+    redis_store.put(session_state(state="RESOURCE_MENU", resource_category="food"))
+    user_session = redis_store.get("abc123")
+    assert (user_session.id, user_session.state, user_session.resource_category) == (1, "RESOURCE_MENU", "food")
+    assert user_session.last_interaction == datetime(2026, 1, 2, 3, 4, 5)
+    assert redis_store.get("someone-else") is None
+
+
+def test_redis_put_sets_the_ttl(redis_store):
+    redis_store.put(session_state())
+    assert 0 < redis_store.client.ttl("sms_session:abc123") <= 60
+    # Each put starts the TTL over
+    redis_store.client.expire("sms_session:abc123", 5)
+    redis_store.put(session_state())
+    assert redis_store.client.ttl("sms_session:abc123") > 5
+
+
+def test_redis_expired_session_is_gone(redis_store):
+    redis_store.put(session_state())
+    redis_store.client.pexpire("sms_session:abc123", 1)
+    time.sleep(0.01)
+    assert redis_store.get("abc123") is None
+
+
+def test_redis_delete(redis_store):
+    redis_store.put(session_state())
+    redis_store.delete("abc123")
+    assert redis_store.get("abc123") is None
+
+
+def test_write_behind_flush_coalesces_changes(app):
+    write_behind = SessionWriteBehind(interval=3600)
+    write_behind.init_app(app)
+    with app.app_context():
+        db.session.add(SMSUser(hashed_phone_number="write-behind-user"))
+        row = SMSUserSession(hashed_phone_number="write-behind-user", state="MAIN_MENU", last_interaction=datetime.now())
+        db.session.add(row)
+        db.session.commit()
+        user_session = SessionState.from_row(row)
+
+    user_session.state = "RESOURCE_MENU"
+    write_behind.enqueue(user_session)
+    user_session.state = "ZIPCODE_INPUT"
+    user_session.resource_category = "food"
+    write_behind.enqueue(user_session)
+    assert write_behind.stats()["pending"] == 1
+
+    write_behind.flush()
+    with app.app_context():
+        row = db.session.get(SMSUserSession, user_session.id)
+        assert (row.state, row.resource_category) == ("ZIPCODE_INPUT", "food")
+    assert write_behind.stats() == {"pending": 0, "written": 1, "failed_flushes": 0}
+
+
+def test_messages_with_the_redis_store(app, client, redis_store, monkeypatch):
+    write_behind = SessionWriteBehind(interval=3600)
+    write_behind.init_app(app)
+    monkeypatch.setattr(chatbot, "session_store", redis_store)
+    monkeypatch.setattr(chatbot, "session_write_behind", write_behind)
+    phone_number = "+15550009999"
+    hashed_phone_number = hash_phone_number(phone_number)
+
+    client.post("/sms", data={"From": phone_number, "Body": "hi"})
+    client.post("/sms", data={"From": phone_number, "Body": "yes"})
+    assert redis_store.get(hashed_phone_number).state == "ASK_RACE_ETHNICITY"
+    assert 0 < redis_store.client.ttl("sms_session:" + hashed_phone_number) <= 60
+
+    # The sessions table catches up when the write-behind flushes
+    write_behind.flush()
+    with app.app_context():
+        assert get_latest_session(hashed_phone_number).state == "ASK_RACE_ETHNICITY"
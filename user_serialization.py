@@ -0,0 +1,56 @@
+# user_serialization.py
+
+"""
+This file contains the per-user serialization of inbound messages.
+When a user sends two texts in quick succession, two gunicorn workers (or threads) can handle them at
+the same time: both see no session and create one each, or both read the same state and one update
+is lost. With SMS_SERIALIZE_USERS=1 the messages of one phone number are handled one at a time:
+
+- On Postgres, each message's transaction starts by taking a transaction-scoped advisory lock on the
+  hashed phone number (pg_advisory_xact_lock). A second message for the same user waits until the first
+  one commits, in any worker process, and then sees everything it wrote. Other users aren't affected.
+- On other databases (SQLite in development), a striped set of in-process locks does the same for the
+  threads of one process.
+
+Creating a user is safe either way: check_create_user inserts with ON CONFLICT DO NOTHING.
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+from sqlalchemy import text
+from database import db, unit_of_work
+
+# Set SMS_SERIALIZE_USERS=1 to handle the messages of each phone number one at a time
+SMS_SERIALIZE_USERS = os.environ.get("SMS_SERIALIZE_USERS", "0") == "1"
+# Number of in-process locks the phone numbers are striped across, when advisory locks aren't available
+USER_LOCK_STRIPES = int(os.environ.get("USER_LOCK_STRIPES", "256"))
+
+_lock_stripes = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+
+
+# The advisory lock key of a user: the first 64 bits of their hashed phone number, as a signed bigint
+def advisory_lock_key(hashed_phone_number):
+    return int.from_bytes(bytes.fromhex(hashed_phone_number[:16]), "big", signed=True)
+
+def uses_advisory_locks():
+    return db.engine.dialect.name == "postgresql"
+
+@contextmanager
+def user_unit_of_work(hashed_phone_number):
+    """
+    unit_of_work() for one message of a user. With SMS_SERIALIZE_USERS on, no other message of the
+    same user runs until this one has committed (or rolled back).
+    """
+    if not SMS_SERIALIZE_USERS:
+        with unit_of_work() as session:
+            yield session
+    elif uses_advisory_locks():
+        with unit_of_work() as session:
+            # Released automatically when the transaction commits or rolls back
+            session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": advisory_lock_key(hashed_phone_number)})
+            yield session
+    else:
+        with _lock_stripes[int(hashed_phone_number[:8], 16) % USER_LOCK_STRIPES]:
+            with unit_of_work() as session:
+                yield session
@@ -1,9 +1,18 @@
-from flask import Blueprint, request, render_template, redirect, url_for, flash
+from flask import Blueprint, request, render_template, redirect, url_for, flash, jsonify, current_app, Response, send_from_directory, abort
 from flask_login import UserMixin, login_user, login_required, logout_user
 import os
 import bleach
-from database import db, EmergencyAlertUsers, EmergencyAlerts
-from twilio.rest import Client
+from alert_broadcast import start_broadcast, recent_broadcasts, broadcast_progress
+from database import db, EmergencyAlerts
+from db_pool import pool_monitor
+from event_writer import event_writer
+from session_store import session_write_behind
+from deferred_replies import deferred_replies
+from metrics import registry
+from chatbot_utils import resource_reply_cache
+from phone_hashing import phone_number_hasher
+from profiler import request_profiler, PROFILE_FILENAME
+from query_budget import query_budget
 from app import limiter
 
 # Blueprint for the website, so that app can have a designated file for the website routes
@@ -71,7 +80,7 @@ def admin_login():
 def admin_dashboard():
     """
     Admin dashboard route. Handles both GET and POST requests.
-    On a POST request, sends an alert message to all users and records the event.
+    On a POST request, starts a background job that sends an alert message to all users and records the event.
     """
     if request.method == 'POST':
         # Get the message from the form
@@ -81,30 +90,79 @@ def admin_dashboard():
             alert_message = "**This is an automated alert**\n\n" + alert_message + "\n\n**End of alert**"
             # Sanitize the message to prevent XSS(security) attacks
             sanitized_message = bleach.clean(alert_message)
-            # Query the database to get all users
-            alert_users = EmergencyAlertUsers.query.all()
-            # Twilio client setup (use your Twilio account SID and auth token)
-            account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-            auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-            from_ = os.getenv('TWILIO_FROM')
-            client = Client(account_sid, auth_token)
-            # For each user, send the message
-            for user in alert_users:
-                client.messages.create(
-                    body=alert_message,
-                    from_=from_,
-                    to=user.phone_number
-                )
-                # Increment the total number of alerts sent for each user
-                user.total_alerts += 1
-            # Add the new alert data to the database
-            number_of_users = len(alert_users)  # Count the number of users signed up for alerts
-            # Create a new EmergencyAlerts object with the sanitized message and the number of users sent
-            new_alert_event = EmergencyAlerts(message=sanitized_message, number_of_users_sent=number_of_users)
-            db.session.add(new_alert_event)
-            db.session.commit()  # Commit the changes to the database
-    # Render the admin dashboard page
-    return render_template('admin_dashboard.html')
+            # The alert is sent to every subscriber by a background job, so the request returns right away.
+            # Its progress is checkpointed to the delivery ledger, so it survives a worker restart.
+            alert = start_broadcast(current_app._get_current_object(), alert_message, sanitized_message)
+            flash(f'Alert queued for sending to {alert.total_recipients} subscribers (alert {alert.id}).')
+            return redirect(url_for('website.admin_dashboard'))
+    # Render the admin dashboard page, with the status of the latest broadcasts
+    return render_template('admin_dashboard.html', broadcasts=recent_broadcasts(),
+                           profiler=request_profiler.stats(), profiles=request_profiler.files())
+
+# Progress and throughput of an alert broadcast, polled by the admin dashboard while it's sending
+@website_blueprint.route('/admin_dashboard/broadcasts/<int:alert_id>', methods=['GET'])
+@login_required
+def broadcast_status(alert_id):
+    alert = db.session.get(EmergencyAlerts, alert_id)
+    if alert is None:
+        return jsonify({'error': 'Unknown alert'}), 404
+    return jsonify(broadcast_progress(alert))
+
+# Health of the database connection pool (checked-out connections, waits, queries per request)
+# and of the background writers that use it
+@website_blueprint.route('/admin_dashboard/health', methods=['GET'])
+@login_required
+def health():
+    return jsonify({
+        'database': pool_monitor.stats(),
+        'event_writer': event_writer.stats(),
+        'session_write_behind': session_write_behind.stats(),
+        'deferred_replies': deferred_replies.stats(),
+        'profiler': request_profiler.stats(),
+        'query_budget': query_budget.stats(),
+    })
+
+# Latency histograms (per state, per phase, per request), query counts and cache hit ratios,
+# in the Prometheus text format (see metrics.py)
+@website_blueprint.route('/metrics', methods=['GET'])
+@login_required
+def metrics():
+    cache_info = phone_number_hasher.cache_info()
+    body = registry.render(stats={
+        'db': pool_monitor.stats(),
+        'event_writer': event_writer.stats(),
+        'session_write_behind': session_write_behind.stats(),
+        'deferred_replies': deferred_replies.stats(),
+        'resource_reply_cache': resource_reply_cache.stats(),
+        'phone_hash_cache': {'hits': cache_info.hits, 'misses': cache_info.misses, 'size': cache_info.currsize},
+    })
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+# Sets the fraction of SMS messages profiled, for every worker process (see profiler.py)
+@website_blueprint.route('/admin_dashboard/profiles/rate', methods=['POST'])
+@login_required
+def profile_rate():
+    try:
+        rate = request_profiler.set_rate(request.form.get('rate', '0'))
+    except ValueError:
+        flash('The profiling rate must be a number between 0 and 1.')
+    else:
+        flash(f'Profiling {rate:.1%} of SMS messages.')
+    return redirect(url_for('website.admin_dashboard'))
+
+# The profile files, newest first
+@website_blueprint.route('/admin_dashboard/profiles', methods=['GET'])
+@login_required
+def profiles():
+    return jsonify({'profiler': request_profiler.stats(), 'files': request_profiler.files()})
+
+# Downloads a profile file (.pstats for pstats/snakeviz, .collapsed for flame graphs)
+@website_blueprint.route('/admin_dashboard/profiles/<filename>', methods=['GET'])
+@login_required
+def download_profile(filename):
+    if not PROFILE_FILENAME.match(filename):
+        abort(404)
+    return send_from_directory(os.path.abspath(request_profiler.directory), filename, as_attachment=True)
 
 # If this route is accessed, the user is logged out and redirected to the onepager
 @website_blueprint.route('/logout', methods=['GET', 'POST'])